@@ -0,0 +1,66 @@
+"""
+Concurrent deep-link lookups with blocking pymongo calls vs. the AsyncCollection executor.
+
+Every simulated /start resolves a distinct link ID (separate IDs per mode), so each one is a cache
+miss that reaches MongoDB. 'sync' calls pymongo directly on the event loop, as handlers did before
+AsyncCollection; 'executor' goes through resolve_link(). Loop lag is the worst delay seen by a task that wakes up every 5 ms,
+i.e. how long every other handler was stalled.
+
+    python benchmarks/bench_async_db.py --requests 200 --latency-ms 5
+"""
+import time
+import asyncio
+import argparse
+
+from harness import load_main, add_latency, report
+
+async def measure(main, mode: str, ids: list):
+    worst_lag = 0.0
+    running = True
+
+    async def ticker():
+        nonlocal worst_lag
+        while running:
+            expected = time.perf_counter() + 0.005
+            await asyncio.sleep(0.005)
+            worst_lag = max(worst_lag, time.perf_counter() - expected)
+
+    async def resolve(file_id_str):
+        if mode == "sync":
+            return main.db.links.sync.find_one({"_id": file_id_str})
+        return await main.resolve_link(file_id_str)
+
+    tick = asyncio.create_task(ticker())
+    await asyncio.sleep(0.01)
+    started = time.perf_counter()
+    results = await asyncio.gather(*(resolve(file_id_str) for file_id_str in ids))
+    elapsed = time.perf_counter() - started
+    running = False
+    await tick
+    assert all(results), "every benchmark link should resolve"
+    return elapsed, worst_lag
+
+async def run(args):
+    main = load_main()
+    ids = {mode: [f"{mode}{i:05d}" for i in range(args.requests)] for mode in ("sync", "executor")}
+    main.db.links.sync.insert_many([
+        {"_id": file_id_str, "type": main.LINK_TYPE_FILE, "log_msg_id": i, "user_id": 1}
+        for mode_ids in ids.values() for i, file_id_str in enumerate(mode_ids)
+    ])
+    main.settings_snapshot.links_migrated = True
+    add_latency(main, "links", args.latency_ms / 1000)
+
+    rows = []
+    for mode in ("sync", "executor"):
+        elapsed, lag = await measure(main, mode, ids[mode])
+        rows.append((mode, f"{elapsed * 1000:.0f}", f"{args.requests / elapsed:.0f}", f"{lag * 1000:.0f}"))
+    report(
+        f"{args.requests} concurrent lookups, +{args.latency_ms} ms per query, {main.MONGO_WORKERS} executor workers",
+        rows, ("mode", "total ms", "lookups/s", "worst loop lag ms"),
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200, help="concurrent lookups (default 200)")
+    parser.add_argument("--latency-ms", type=float, default=5, help="simulated round trip added to every query (default 5)")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,54 @@
+"""
+Bundle-building throughput: $push plus a re-read of the session vs. one find_one_and_update.
+
+file_handler used to push each forwarded file's ID and then read the whole session back to count
+message_ids, so every file shipped the growing array. session_store.add_bundle_message() pushes and
+returns a maintained file_count in one round trip. Add --latency-ms to simulate a remote MongoDB.
+
+    python benchmarks/bench_bundle_build.py --sizes 10 100 1000
+"""
+import time
+import asyncio
+import argparse
+
+import bson
+
+from harness import load_main, add_latency, report
+
+async def push_and_reread(main, user_id: int, message_id: int):
+    """The pre-file_count file_handler path; returns the count and the bytes read back."""
+    await main.db.sessions.update_one({"_id": user_id}, {"$push": {"message_ids": message_id}})
+    session = await main.db.sessions.find_one({"_id": user_id})
+    return len(session.get("message_ids", [])), len(bson.encode(session))
+
+async def run(args):
+    main = load_main()
+    add_latency(main, "sessions", args.latency_ms / 1000)
+
+    rows = []
+    for size in args.sizes:
+        for name in ("push + re-read", "find_one_and_update"):
+            user_id = size * 10 + (name == "find_one_and_update")
+            await main.session_store.start_bundle(user_id, force_channel=None, file_name=None, thumbnail_id=None)
+            read_back = 0
+            started = time.perf_counter()
+            for message_id in range(1, size + 1):
+                if name == "push + re-read":
+                    count, returned = await push_and_reread(main, user_id, message_id)
+                    read_back += returned
+                else:
+                    count = await main.session_store.add_bundle_message(user_id, message_id)
+                    read_back += len(bson.encode({"file_count": count}))
+            elapsed = time.perf_counter() - started
+            assert count == size
+            rows.append((size, name, f"{elapsed * 1000:.0f}", f"{size / elapsed:.0f}", f"{read_back / 1024:.0f}"))
+    report(
+        f"adding files to one bundle, +{args.latency_ms} ms per query",
+        rows, ("files", "approach", "total ms", "files/s", "KiB read back"),
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000], help="files per bundle (default 10 100 1000)")
+    parser.add_argument("--latency-ms", type=float, default=0, help="simulated round trip added to every query (default 0)")
+    asyncio.run(run(parser.parse_args()))
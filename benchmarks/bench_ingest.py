@@ -0,0 +1,146 @@
+"""
+Bundle finalisation time per bundle size: the old per-file loop vs. ingest_bundle().
+
+The old /done fetched and copied one file at a time with a fixed 0.1 s sleep between files.
+ingest_bundle() batches get_messages and copies with INGEST_CONCURRENCY workers, paced by the
+LOG_CHANNEL bucket (LOG_CHANNEL_RATE, overridable with --log-rate), which halves its rate on
+every FloodWait. Telegram is a fake client with a fixed round trip per call that allows --tg-rate
+sends per second to one chat and answers anything faster with a FloodWait of --flood-wait seconds.
+The old loop sleeps through FloodWaits and retries, as Pyrogram did for it.
+
+A second table times a single-file upload that arrives while a bundle is being copied, with and
+without BACKGROUND_SEND_RESERVE.
+
+    python benchmarks/bench_ingest.py --sizes 10 50 200 --rtt-ms 100 --tg-rate 20
+"""
+import math
+import time
+import asyncio
+import logging
+import argparse
+from collections import deque
+from types import SimpleNamespace
+
+from pyrogram.errors import FloodWait
+
+from harness import load_main, report
+
+class FakeClient:
+    """Serves get_messages/copy_message after a simulated round trip, enforcing a per-chat send rate."""
+
+    def __init__(self, rtt: float, tg_rate: float, flood_wait: int):
+        self.rtt = rtt
+        self.tg_rate = tg_rate
+        self.flood_wait = flood_wait
+        self.calls = 0
+        self.flood_waits = 0
+        self._sent = deque() # send times in the last second
+        self._blocked_until = 0.0
+        self._next_id = 0
+
+    def _message(self, message_id):
+        return SimpleNamespace(
+            id=message_id, empty=False, chat=SimpleNamespace(id=1), caption=None, reply_markup=None,
+            document=SimpleNamespace(file_id=f"doc{message_id}"), video=None, audio=None,
+        )
+
+    async def get_messages(self, chat_id, message_ids):
+        self.calls += 1
+        await asyncio.sleep(self.rtt)
+        if isinstance(message_ids, list):
+            return [self._message(message_id) for message_id in message_ids]
+        return self._message(message_ids)
+
+    async def copy_message(self, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.rtt)
+        now = time.monotonic()
+        while self._sent and self._sent[0] <= now - 1:
+            self._sent.popleft()
+        if now >= self._blocked_until and len(self._sent) >= self.tg_rate:
+            self._blocked_until = now + self.flood_wait
+        if now < self._blocked_until:
+            self.flood_waits += 1
+            raise FloodWait(value=math.ceil(self._blocked_until - now))
+        self._sent.append(now)
+        self._next_id += 1
+        return SimpleNamespace(id=self._next_id)
+
+async def per_file_loop(main, client, user_id, message_ids):
+    """The pre-ingest_bundle /done loop."""
+    forwarded = []
+    for message_id in message_ids:
+        original_message = await client.get_messages(user_id, message_id)
+        while True:
+            try:
+                copied = await client.copy_message(
+                    chat_id=main.LOG_CHANNEL, from_chat_id=original_message.chat.id, message_id=original_message.id,
+                    caption=original_message.caption, reply_markup=original_message.reply_markup,
+                )
+                break
+            except FloodWait as e:
+                await asyncio.sleep(e.value)
+        forwarded.append(copied.id)
+        await asyncio.sleep(0.1)
+    return forwarded
+
+def reset_buckets(main, log_rate: float):
+    """Fresh buckets per run so one run's spent tokens or slow-downs do not affect the next."""
+    main.chat_send_buckets = main.TTLCache(maxsize=20000, ttl=300)
+    main.global_send_bucket = main.TokenBucket(rate=main.DELIVERY_GLOBAL_RATE, capacity=main.DELIVERY_GLOBAL_RATE)
+    main.log_channel_buckets = {
+        main.LOG_CHANNEL: main.TokenBucket(rate=log_rate, capacity=main.LOG_CHANNEL_BURST, min_rate=main.LOG_CHANNEL_MIN_RATE)
+    }
+
+async def finalisation(main, args, log_rate: float):
+    rows = []
+    for size in args.sizes:
+        message_ids = list(range(1, size + 1))
+        for name in ("per-file loop", "ingest_bundle"):
+            reset_buckets(main, log_rate)
+            client = FakeClient(args.rtt_ms / 1000, args.tg_rate, args.flood_wait)
+            started = time.perf_counter()
+            if name == "per-file loop":
+                copied = len(await per_file_loop(main, client, 1, message_ids))
+            else:
+                copied = len(await main.ingest_bundle(client, 1, message_ids))
+            elapsed = time.perf_counter() - started
+            assert copied == size
+            rows.append((size, name, f"{elapsed:.2f}", client.calls, client.flood_waits))
+    report(
+        f"round trip {args.rtt_ms} ms, Telegram allows {args.tg_rate}/s, LOG_CHANNEL bucket {log_rate}/s, "
+        f"{main.INGEST_CONCURRENCY} copy workers",
+        rows, ("files", "approach", "seconds", "RPCs", "FloodWait replies"),
+    )
+
+async def upload_during_bundle(main, args, log_rate: float):
+    """Latency of one interactive copy started while the largest bundle is being ingested."""
+    rows = []
+    size = max(args.sizes)
+    for reserve in (0, main.BACKGROUND_SEND_RESERVE):
+        main.BACKGROUND_SEND_RESERVE = reserve
+        reset_buckets(main, log_rate)
+        client = FakeClient(args.rtt_ms / 1000, args.tg_rate, args.flood_wait)
+        bundle = asyncio.create_task(main.ingest_bundle(client, 1, list(range(1, size + 1))))
+        await asyncio.sleep(1)
+        started = time.perf_counter()
+        await main.copy_to_log_channel(client, client._message(10_000))
+        rows.append((reserve, f"{(time.perf_counter() - started) * 1000:.0f}"))
+        await bundle
+    report(f"single-file upload during a {size}-file bundle", rows, ("background reserve", "upload ms"))
+
+async def run(args):
+    main = load_main()
+    logging.getLogger("main").setLevel(logging.ERROR) # FloodWaits are counted in the table instead
+    log_rate = args.log_rate or main.LOG_CHANNEL_RATE
+    await finalisation(main, args, log_rate)
+    await upload_during_bundle(main, args, log_rate)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 50, 200], help="bundle sizes (default 10 50 200)")
+    parser.add_argument("--rtt-ms", type=float, default=100, help="simulated Telegram round trip (default 100)")
+    parser.add_argument("--tg-rate", type=float, default=20, help="sends per second Telegram accepts in one chat (default 20)")
+    parser.add_argument("--flood-wait", type=int, default=3, help="FloodWait seconds when exceeded (default 3)")
+    parser.add_argument("--log-rate", type=float, help="LOG_CHANNEL bucket rate (default LOG_CHANNEL_RATE)")
+    asyncio.run(run(parser.parse_args()))
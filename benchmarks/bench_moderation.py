@@ -0,0 +1,72 @@
+"""
+Group moderation scan rate: messages per second through find_badword().
+
+Generates a synthetic chat log (plain Latin chat, non-Latin chat, innocent lookalikes of short
+BADWORDS entries, and messages containing a BADWORDS entry, plain or disguised) and scans every
+message as group_message_handler would. Lookalikes must never match.
+
+    python benchmarks/bench_moderation.py --messages 1000000
+"""
+import time
+import random
+import argparse
+
+from harness import load_main, report
+
+LATIN_WORDS = "hello anyone watched the new episode link please share thanks bro where is part two movie song".split()
+OTHER_WORDS = "नमस्ते भाई कोई लिंक भेजो धन्यवाद привет кто смотрел новую серию спасибо".split()
+# Ordinary text that once matched the default BADWORDS through leetspeak or letter collapsing
+LOOKALIKES = ["please bcc me", "the burr oak", "MCC won", "Ok 8c", "score was 50", "Kuta beach", "Book club", "bccc"]
+
+def disguise(main, word: str, rng: random.Random) -> str:
+    """Uppercases, stretches or leetspeaks a bad word the way spammers do."""
+    style = rng.randrange(4)
+    if style == 0 or (style == 1 and len(word) < main.COLLAPSE_MIN_LENGTH):
+        return word.upper()
+    if style == 1:
+        i = rng.randrange(len(word))
+        return word[:i] + word[i] * rng.randint(3, 5) + word[i + 1:]
+    if style == 2:
+        return word.translate(str.maketrans("aeios", "43105"))
+    return word
+
+def synthetic_messages(main, count: int, rng: random.Random) -> dict:
+    """Returns {kind: [messages]}: 65% Latin chat, 20% non-Latin chat, 5% lookalikes, 10% with a bad word."""
+    messages = {"latin chat": [], "non-latin chat": [], "lookalikes": [], "with bad word": []}
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.65:
+            messages["latin chat"].append(" ".join(rng.choices(LATIN_WORDS, k=rng.randint(3, 15))))
+        elif roll < 0.85:
+            messages["non-latin chat"].append(" ".join(rng.choices(OTHER_WORDS, k=rng.randint(3, 15))))
+        elif roll < 0.9:
+            words = rng.choices(LATIN_WORDS, k=rng.randint(0, 6))
+            words.insert(rng.randrange(len(words) + 1), rng.choice(LOOKALIKES))
+            messages["lookalikes"].append(" ".join(words))
+        else:
+            words = rng.choices(LATIN_WORDS, k=rng.randint(2, 10))
+            words.insert(rng.randrange(len(words) + 1), disguise(main, rng.choice(main.BADWORDS), rng))
+            messages["with bad word"].append(" ".join(words))
+    return messages
+
+def run(args):
+    main = load_main()
+    messages = synthetic_messages(main, args.messages, random.Random(args.seed))
+
+    rows = []
+    total_count, total_elapsed = 0, 0.0
+    for kind, texts in messages.items():
+        started = time.perf_counter()
+        hits = sum(1 for text in texts if main.find_badword(text))
+        elapsed = time.perf_counter() - started
+        total_count += len(texts)
+        total_elapsed += elapsed
+        rows.append((kind, len(texts), f"{len(texts) / elapsed:,.0f}", hits))
+    rows.append(("all", total_count, f"{total_count / total_elapsed:,.0f}", ""))
+    report(f"find_badword over {len(main.BADWORDS)} BADWORDS", rows, ("messages", "count", "msg/s", "matched"))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=1000000, help="messages to scan (default 1000000)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed (default 1)")
+    run(parser.parse_args())
@@ -0,0 +1,86 @@
+"""
+RPCs per spam message during a simulated group raid.
+
+Spammers post links and abusive messages into one group at --rate messages/sec. Every message goes
+through group_message_handler against a fake Telegram client that counts the calls it receives;
+ModerationQueue batching and the digest run for real, with all delays divided by --time-scale.
+The 'old handler' row is what the pre-ModerationQueue code path spends on the same raid: a delete,
+a notice and a GROUP_LOG_CHANNEL message per removal, plus one restrict per punishment.
+
+    python benchmarks/bench_moderation_raid.py --messages 150 --spammers 10
+"""
+import asyncio
+import argparse
+from collections import Counter
+from types import SimpleNamespace
+
+from harness import load_main, report
+
+class FakeClient:
+    """Records every moderation call the bot makes."""
+
+    def __init__(self, log_channel: int):
+        self.log_channel = log_channel
+        self.calls = Counter()
+
+    async def delete_messages(self, chat_id, message_ids):
+        self.calls["delete_messages"] += 1
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls["send_message (log)" if chat_id == self.log_channel else "send_message (group)"] += 1
+        return SimpleNamespace(id=0)
+
+    async def restrict_chat_member(self, *args, **kwargs):
+        self.calls["restrict_chat_member"] += 1
+
+    async def ban_chat_member(self, *args, **kwargs):
+        self.calls["ban_chat_member"] += 1
+
+def raid_message(main, message_id: int, spammer: int):
+    """Odd IDs carry a link, even IDs a bad word."""
+    has_link = message_id % 2 == 1
+    return SimpleNamespace(
+        id=message_id,
+        chat=SimpleNamespace(id=-100200300, title="Bench Group"),
+        from_user=SimpleNamespace(id=10_000 + spammer, is_bot=False, first_name=f"Spammer{spammer}", last_name=None),
+        text="cheap followers https://example.com" if has_link else "you are a fuuuck",
+        caption=None,
+        entities=[SimpleNamespace(type=main.enums.MessageEntityType.URL)] if has_link else None,
+        caption_entities=None,
+    )
+
+async def run(args):
+    main = load_main()
+    client = FakeClient(main.GROUP_LOG_CHANNEL)
+    main.bot_context.ready.set()
+    main.moderation_queue.batch_delay = main.MODERATION_BATCH_DELAY / args.time_scale
+    main.moderation_queue.digest_interval = main.MODERATION_DIGEST_INTERVAL / args.time_scale
+    main.moderation_queue.start()
+    main.log_sink.interval = main.LOG_FLUSH_INTERVAL / args.time_scale
+    main.log_sink.start(client)
+
+    for message_id in range(args.messages):
+        await main.group_message_handler(client, raid_message(main, message_id, message_id % args.spammers))
+        await asyncio.sleep(1 / args.rate / args.time_scale)
+    # Let the last batch, one digest and one log flush go out
+    await asyncio.sleep(main.moderation_queue.batch_delay + main.moderation_queue.digest_interval + 0.1)
+    await main.log_sink.stop(client)
+
+    queue = main.moderation_queue
+    punishments = client.calls["restrict_chat_member"] + client.calls["ban_chat_member"]
+    old_rpcs = 3 * queue.removed + punishments
+    rows = [(name, count) for name, count in sorted(client.calls.items())]
+    rows.append(("total", sum(client.calls.values())))
+    report(f"raid of {args.messages} messages from {args.spammers} users at {args.rate}/s", rows, ("Telegram call", "count"))
+    report("RPCs per removed message", [
+        ("ModerationQueue", queue.removed, queue.rpcs, f"{queue.rpcs / queue.removed:.2f}"),
+        ("old handler", queue.removed, old_rpcs, f"{old_rpcs / queue.removed:.2f}"),
+    ], ("path", "removed", "RPCs", "per message"))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--messages", type=int, default=150, help="raid size (default 150)")
+    parser.add_argument("--spammers", type=int, default=10, help="distinct spamming users (default 10)")
+    parser.add_argument("--rate", type=float, default=50, help="raid messages per second (default 50)")
+    parser.add_argument("--time-scale", type=float, default=20, help="speed-up applied to every delay (default 20)")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,108 @@
+"""
+Inline search latency: case-insensitive $regex over file_name vs. prefix matches on indexed tokens.
+
+Inserts --files synthetic links for one user, so every query searches the whole library, creates
+REQUIRED_INDEXES, and times the old inline-search query against find_search_candidates() plus
+ranking. mongomock uses no indexes, so the token comparison is only meaningful against a real
+server:
+
+    BENCH_MONGO_URI=mongodb://localhost:27017 python benchmarks/bench_search.py --files 1000000
+"""
+import re
+import time
+import random
+import asyncio
+import argparse
+import statistics
+from datetime import datetime, timedelta
+
+from harness import load_main, report
+
+USER_ID = 1
+
+def synthetic_names(count: int, rng: random.Random):
+    """File names shaped like real uploads: a few words from a large vocabulary, a year, a quality tag."""
+    syllables = ["ka", "ri", "mo", "tan", "vel", "sho", "dra", "lin", "por", "ex", "qui", "zen", "bar", "tor", "mi", "ne"]
+    vocabulary = list({"".join(rng.choices(syllables, k=rng.randint(2, 4))) for _ in range(20000)})
+    qualities = ["480p", "720p", "1080p", "2160p"]
+    extensions = ["mkv", "mp4", "pdf", "zip", "mp3"]
+    for _ in range(count):
+        words = ".".join(word.capitalize() for word in rng.sample(vocabulary, rng.randint(2, 5)))
+        yield f"{words}.{rng.randint(1990, 2025)}.{rng.choice(qualities)}.{rng.choice(extensions)}"
+
+def insert_links(main, count: int, rng: random.Random, batch_size: int = 10000):
+    started_at = datetime(2024, 1, 1)
+    batch = []
+    for i, file_name in enumerate(synthetic_names(count, rng)):
+        batch.append({
+            "_id": f"bench{i:07d}", "type": main.LINK_TYPE_FILE, "user_id": USER_ID, "log_msg_id": i,
+            "file_name": file_name, "tokens": main.search_tokens(file_name),
+            "tokens_version": main.SEARCH_TOKENS_VERSION, "created_at": started_at + timedelta(seconds=i),
+        })
+        if len(batch) == batch_size:
+            main.db.links.sync.insert_many(batch)
+            batch = []
+    if batch:
+        main.db.links.sync.insert_many(batch)
+
+def sample_queries(main, count: int, rng: random.Random) -> list:
+    """Word prefixes taken from stored names; every third query has two terms."""
+    stored = main.db.links.sync.find({}, {"tokens": 1}).limit(2000)
+    words = [token for record in stored for token in record["tokens"] if not token.isdigit()]
+    queries = []
+    for i in range(count):
+        terms = [word[:rng.randint(3, len(word))] for word in rng.sample(words, 2 if i % 3 == 0 else 1)]
+        queries.append(" ".join(terms))
+    return queries
+
+async def old_search(main, query: str) -> list:
+    return await main.db.links.find(
+        {"user_id": USER_ID, "file_name": {"$regex": query, "$options": "i"}},
+        sort=[("created_at", -1)],
+        limit=15
+    )
+
+async def token_search(main, query: str) -> list:
+    terms = main.search_tokens(query)
+    return main.rank_search_results(await main.find_search_candidates(USER_ID, terms), terms)
+
+async def run(args):
+    main = load_main()
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    insert_links(main, args.files, rng)
+    await main.ensure_indexes()
+    print(f"Inserted {args.files} links in {time.perf_counter() - started:.1f}s")
+    queries = sample_queries(main, args.queries, rng)
+
+    rows = []
+    for name, search in (("$regex on file_name", old_search), ("token prefixes", token_search)):
+        timings, hits = [], 0
+        for query in queries:
+            started = time.perf_counter()
+            hits += bool(await search(main, query))
+            timings.append(time.perf_counter() - started)
+        timings.sort()
+        rows.append((
+            name, f"{statistics.median(timings) * 1000:.1f}", f"{timings[int(len(timings) * 0.95) - 1] * 1000:.1f}",
+            f"{hits}/{len(queries)}",
+        ))
+    report(f"{args.queries} queries over {args.files} files", rows, ("query", "median ms", "p95 ms", "with results"))
+
+    terms = main.search_tokens(queries[0])
+    try:
+        explain = await main.db.links.explain(
+            {"user_id": USER_ID, "$and": [{"tokens": {"$regex": f"^{re.escape(term)}"}} for term in terms]},
+            sort=[("created_at", -1)], limit=main.SEARCH_CANDIDATES
+        )
+        stages = list(main._plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {})))
+        print(f"\nToken search plan for {queries[0]!r}: {' <- '.join(stages)}")
+    except Exception as e:
+        print(f"\nToken search plan not available: {e}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--files", type=int, default=20000, help="synthetic links (default 20000; use 1000000 with a real server)")
+    parser.add_argument("--queries", type=int, default=50, help="queries per approach (default 50)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for names and queries (default 1)")
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,58 @@
+"""
+Link generation latency: a get_me() call per link vs. the cached bot_context identity.
+
+Handlers used to call client.get_me() before building every link; now bot_context resolves the
+identity once at startup. get_me() is simulated with a fixed round trip (--rtt-ms), the rest is real.
+
+    python benchmarks/bench_share_link.py --links 200 --rtt-ms 50
+"""
+import time
+import asyncio
+import argparse
+from types import SimpleNamespace
+
+from harness import load_main, report
+
+class FakeClient:
+    """Answers get_me() after a simulated Telegram round trip and counts the calls."""
+
+    def __init__(self, rtt: float):
+        self.rtt = rtt
+        self.calls = 0
+
+    async def get_me(self):
+        self.calls += 1
+        await asyncio.sleep(self.rtt)
+        return SimpleNamespace(id=1, username="FileLinkBenchBot")
+
+async def run(args):
+    main = load_main()
+    ids = [f"bench{i:05d}" for i in range(args.links)]
+
+    async def get_me_per_link(client):
+        for file_id_str in ids:
+            me = await client.get_me()
+            f"https://t.me/{me.username}?start={file_id_str}"
+
+    async def cached_identity(client):
+        await main.bot_context.refresh(client)
+        for file_id_str in ids:
+            main.bot_context.share_link(file_id_str)
+
+    rows = []
+    for name, build in (("get_me per link", get_me_per_link), ("bot_context", cached_identity)):
+        client = FakeClient(args.rtt_ms / 1000)
+        started = time.perf_counter()
+        await build(client)
+        elapsed = time.perf_counter() - started
+        rows.append((name, f"{elapsed * 1000:.1f}", f"{elapsed / args.links * 1e6:.1f}", client.calls))
+    report(
+        f"{args.links} links, get_me() round trip {args.rtt_ms} ms",
+        rows, ("approach", "total ms", "us per link", "get_me calls"),
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--links", type=int, default=200, help="links to build (default 200)")
+    parser.add_argument("--rtt-ms", type=float, default=50, help="simulated get_me() round trip (default 50)")
+    asyncio.run(run(parser.parse_args()))
@@ -1,36 +1,156 @@
 import os
 import logging
-import random
 import string
 import time
 import asyncio
 import urllib.parse
+import re
+import unicodedata
+import functools
+import json
+import contextvars
 from dotenv import load_dotenv
-from pyrogram import Client, filters, idle
-from pyrogram.errors import UserNotParticipant, ChatAdminRequired
+from pyrogram import Client, filters, idle, enums
+from pyrogram.errors import (
+    UserNotParticipant, ChatAdminRequired, FloodWait,
+    UserIsBlocked, InputUserDeactivated
+)
 from pyrogram.types import (
     InlineKeyboardButton, InlineKeyboardMarkup, Message,
     CallbackQuery, InlineQueryResultArticle,
-    InputTextMessageContent, ChatPermissions
+    InputTextMessageContent, ChatPermissions,
+    InputMediaPhoto, InputMediaVideo, InputMediaDocument, InputMediaAudio
 )
-from pymongo import MongoClient
-from pymongo.errors import DuplicateKeyError
-from flask import Flask
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from aiohttp import web
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 from threading import Thread
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict, deque
 
-# --- Flask Web Server (To keep the bot alive) ---
-flask_app = Flask(__name__)
+try:
+    import redis.asyncio as aioredis # Only needed for SESSION_BACKEND=redis
+except ImportError:
+    aioredis = None
+
+# --- Metrics ---
+# Prometheus metrics, served at /metrics by the health server (see Health & Metrics Server).
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Time spent in each update handler", ["handler"])
+MONGO_OP_SECONDS = Histogram(
+    "bot_mongo_op_seconds", "Duration of Mongo operations", ["collection", "op"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+FLOODWAIT_TOTAL = Counter("bot_floodwait_total", "FloodWait errors returned by Telegram", ["source"])
+FLOODWAIT_SECONDS = Counter("bot_floodwait_seconds_total", "Seconds Telegram asked us to wait", ["source"])
+QUEUE_DEPTH = Gauge("bot_queue_depth", "Items waiting in in-process queues", ["queue"])
+
+def record_flood_wait(source: str, seconds: float):
+    FLOODWAIT_TOTAL.labels(source=source).inc()
+    FLOODWAIT_SECONDS.labels(source=source).inc(seconds)
+
+# --- Tracing ---
+# Every handler runs inside a trace (see instrument_handler). Mongo calls and Telegram RPCs made while
+# it runs are recorded as spans on that trace, so /perf can show where a slow handler spends its time.
+# Only the most recent PERF_WINDOW runs of each handler are kept for the percentiles.
+PERF_WINDOW = int(os.environ.get("PERF_WINDOW", 1000))
+SLOW_HANDLER_SECONDS = float(os.environ.get("SLOW_HANDLER_SECONDS", 2))
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+class Trace:
+    """Time spent per span name (e.g. 'mongo.links.find_one', 'tg.SendMessage') during one handler run."""
+
+    def __init__(self, handler: str):
+        self.handler = handler
+        self.spans = {} # name -> [count, seconds]
+        self.finished = False
+
+    def add(self, name: str, seconds: float):
+        span = self.spans.setdefault(name, [0, 0.0])
+        span[0] += 1
+        span[1] += seconds
+
+    def breakdown_text(self) -> str:
+        return ", ".join(f"{name} x{count} {seconds * 1000:.0f}ms" for name, (count, seconds) in
+                         sorted(self.spans.items(), key=lambda item: item[1][1], reverse=True))
+
+def record_span(name: str, seconds: float):
+    """Adds a span to the handler trace of the current task, if there is one still running."""
+    trace = current_trace.get()
+    if trace is not None and not trace.finished:
+        trace.add(name, seconds)
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    return sorted_values[round(fraction * (len(sorted_values) - 1))]
+
+class PerfStats:
+    """Recent handler durations and accumulated span time per handler, reported by /perf."""
+
+    def __init__(self, window: int):
+        self.window = window
+        self._durations = {} # handler -> deque of recent durations
+        self._calls = {}
+        self._spans = {} # handler -> {span name: [count, seconds]}
+
+    def record(self, trace: Trace, seconds: float):
+        self._durations.setdefault(trace.handler, deque(maxlen=self.window)).append(seconds)
+        self._calls[trace.handler] = self._calls.get(trace.handler, 0) + 1
+        spans = self._spans.setdefault(trace.handler, {})
+        for name, (count, span_seconds) in trace.spans.items():
+            total = spans.setdefault(name, [0, 0.0])
+            total[0] += count
+            total[1] += span_seconds
+
+    def report(self, limit: int = 8, breakdown: int = 4) -> str:
+        """The `limit` handlers with the highest p95, each with its most expensive span names."""
+        rows = []
+        for handler, durations in self._durations.items():
+            values = sorted(durations)
+            rows.append((percentile(values, 0.95), handler, values))
+        if not rows:
+            return "No handler runs recorded yet."
+
+        lines = []
+        for p95, handler, values in sorted(rows, reverse=True)[:limit]:
+            calls = self._calls[handler]
+            lines.append(
+                f"**{handler}** ({calls} calls)\n"
+                f"  p50 `{percentile(values, 0.5) * 1000:.0f}ms` · p95 `{p95 * 1000:.0f}ms` · "
+                f"p99 `{percentile(values, 0.99) * 1000:.0f}ms` · max `{values[-1] * 1000:.0f}ms`"
+            )
+            top_spans = sorted(self._spans[handler].items(), key=lambda item: item[1][1], reverse=True)[:breakdown]
+            for name, (count, seconds) in top_spans:
+                lines.append(f"  • `{name}`: {count / calls:.1f}/call, avg `{seconds / calls * 1000:.0f}ms`/call")
+        return "\n".join(lines)
 
-@flask_app.route('/')
-def index():
-    return "Bot is alive! 🚀", 200
+perf_stats = PerfStats(PERF_WINDOW)
 
-def run_flask():
-    """Runs the Flask web server."""
-    port = int(os.environ.get('PORT', 8080))
-    # Use Threaded to handle multiple requests smoothly
-    flask_app.run(host='0.0.0.0', port=port, threaded=True)
+def instrument_handler(func):
+    """
+    Runs the handler inside a Trace and records its duration in perf_stats and HANDLER_SECONDS.
+    Goes directly below @app.on_*. Runs slower than SLOW_HANDLER_SECONDS are logged with their spans.
+    """
+    histogram = HANDLER_SECONDS.labels(handler=func.__name__)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        if not bot_context.ready.is_set():
+            await bot_context.ready.wait() # Updates dispatched before the startup get_me() finished
+        trace = Trace(func.__name__)
+        token = current_trace.set(trace)
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            trace.finished = True # Tasks spawned by the handler inherit the trace; stop them adding to it
+            current_trace.reset(token)
+            histogram.observe(elapsed)
+            perf_stats.record(trace, elapsed)
+            if elapsed > SLOW_HANDLER_SECONDS:
+                logger.warning(f"🐢 Slow handler {func.__name__}: {elapsed:.2f}s ({trace.breakdown_text() or 'no spans'})")
+    return wrapper
 
 # --- Basic Logging ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -65,11 +185,95 @@ except (ValueError, TypeError) as e:
     logger.error(f"❌ Environment variables configuration error: {e}")
     exit()
 
+# --- Async Database Layer ---
+# pymongo is a blocking driver. Every call made from a handler goes through this layer,
+# which runs it on a bounded thread pool so a slow Atlas round-trip only occupies one
+# worker thread instead of freezing the whole Pyrogram dispatcher.
+MONGO_WORKERS = int(os.environ.get("MONGO_WORKERS", 16))
+mongo_executor = ThreadPoolExecutor(max_workers=MONGO_WORKERS, thread_name_prefix="mongo")
+
+class AsyncCollection:
+    """Awaitable wrapper around a pymongo collection. Cursors are materialised in the executor."""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    @property
+    def sync(self):
+        """The underlying pymongo collection, for startup code that may block."""
+        return self._collection
+
+    async def _run(self, op: str, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(mongo_executor, functools.partial(func, *args, **kwargs))
+        finally:
+            elapsed = time.perf_counter() - started
+            MONGO_OP_SECONDS.labels(collection=self._collection.name, op=op).observe(elapsed)
+            record_span(f"mongo.{self._collection.name}.{op}", elapsed)
+
+    async def find_one(self, *args, **kwargs):
+        return await self._run("find_one", self._collection.find_one, *args, **kwargs)
+
+    async def find(self, *args, **kwargs):
+        """Runs a find() and returns the results as a list. Use sort=/limit= keyword arguments."""
+        return await self._run("find", lambda: list(self._collection.find(*args, **kwargs)))
+
+    async def aggregate(self, pipeline, **kwargs):
+        return await self._run("aggregate", lambda: list(self._collection.aggregate(pipeline, **kwargs)))
+
+    async def count_documents(self, *args, **kwargs):
+        return await self._run("count_documents", self._collection.count_documents, *args, **kwargs)
+
+    async def insert_one(self, *args, **kwargs):
+        return await self._run("insert_one", self._collection.insert_one, *args, **kwargs)
+
+    async def update_one(self, *args, **kwargs):
+        return await self._run("update_one", self._collection.update_one, *args, **kwargs)
+
+    async def find_one_and_update(self, *args, **kwargs):
+        return await self._run("find_one_and_update", self._collection.find_one_and_update, *args, **kwargs)
+
+    async def bulk_write(self, *args, **kwargs):
+        return await self._run("bulk_write", self._collection.bulk_write, *args, **kwargs)
+
+    async def delete_one(self, *args, **kwargs):
+        return await self._run("delete_one", self._collection.delete_one, *args, **kwargs)
+
+    async def delete_many(self, *args, **kwargs):
+        return await self._run("delete_many", self._collection.delete_many, *args, **kwargs)
+
+    async def create_index(self, *args, **kwargs):
+        return await self._run("create_index", self._collection.create_index, *args, **kwargs)
+
+    async def explain(self, filter, **kwargs):
+        """Returns the explain() output of a find() with the same filter and sort=/limit= keywords."""
+        return await self._run("explain", lambda: self._collection.find(filter, **kwargs).explain())
+
+class AsyncDatabase:
+    """Exposes every collection of a pymongo database as an AsyncCollection (db.files, db.users, ...)."""
+
+    def __init__(self, database):
+        self._database = database
+        self._collections = {}
+
+    @property
+    def sync(self):
+        return self._database
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name not in self._collections:
+            self._collections[name] = AsyncCollection(self._database[name])
+        return self._collections[name]
+
 # --- Database Setup ---
 try:
     # Use serverSelectionTimeoutMS for quick fail on connection issues
-    client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000)
-    db = client['file_link_bot_ultimate']
+    client = MongoClient(MONGO_URI, serverSelectionTimeoutMS=5000, maxPoolSize=MONGO_WORKERS)
+    db = AsyncDatabase(client['file_link_bot_ultimate'])
     # The ismaster command is cheap and does not requires auth.
     client.admin.command('ismaster') 
     logger.info("✅ MongoDB connected successfully!")
@@ -78,28 +282,460 @@ except Exception as e:
     exit()
 
 # --- Pyrogram Client ---
-app = Client(
+# Pyrogram sleeps through FloodWaits of up to sleep_threshold seconds on its own. Calls made while
+# this is set (see send_with_flood_control) get the FloodWait raised instead, so the caller can slow down.
+raise_flood_wait = contextvars.ContextVar("raise_flood_wait", default=False)
+
+class TracedClient(Client):
+    """Pyrogram client that records every raw API call as a span on the current handler trace."""
+
+    async def invoke(self, query, *args, **kwargs):
+        if raise_flood_wait.get() and not args:
+            kwargs.setdefault("sleep_threshold", 0)
+        started = time.perf_counter()
+        try:
+            return await super().invoke(query, *args, **kwargs)
+        finally:
+            record_span(f"tg.{type(query).__name__}", time.perf_counter() - started)
+
+app = TracedClient(
     "FileLinkBot",
     api_id=API_ID,
     api_hash=API_HASH,
     bot_token=BOT_TOKEN
 )
 
+# --- Bot Identity ---
+
+class BotContext:
+    """
+    The bot's own identity, resolved once at startup so building a link costs no RPCs.
+    Call refresh() again if the bot's username is changed in BotFather. Handlers wait for
+    `ready` (see instrument_handler), because app.start() already dispatches queued updates.
+    """
+
+    def __init__(self):
+        self.id = None
+        self.username = None
+        self.ready = asyncio.Event()
+
+    async def refresh(self, client: Client):
+        me = await client.get_me()
+        self.id = me.id
+        self.username = me.username
+        self.ready.set()
+        logger.info(f"🤖 Bot identity resolved: @{self.username} ({self.id})")
+
+    def _require_username(self) -> str:
+        if self.username is None:
+            raise RuntimeError("Bot identity is not resolved yet; call bot_context.refresh() first.")
+        return self.username
+
+    def share_link(self, file_id_str: str) -> str:
+        """The full deep link that delivers a file or bundle."""
+        return f"https://t.me/{self._require_username()}?start={file_id_str}"
+
+    def short_link(self, file_id_str: str) -> str:
+        """The deep link without the scheme, as used in log messages."""
+        return f"t.me/{self._require_username()}?start={file_id_str}"
+
+bot_context = BotContext()
+
+# --- In-Process Caches ---
+
+class TTLCache:
+    """A bounded LRU cache whose entries also expire after a time-to-live. Tracks hits and misses."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self._data.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, ttl: float = None):
+        self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        entry = self._data.pop(key, None)
+        return entry[1] if entry else None
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats_text(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = (self.hits / lookups * 100) if lookups else 0.0
+        return f"{self.hits} hits / {self.misses} misses ({hit_rate:.1f}%), {len(self)}/{self.maxsize} entries"
+
+# Deep-link records are immutable once created (only deleted), so they can be cached safely.
+# A miss is cached for a shorter time so a mistyped link does not hit Mongo on every retry.
+LINK_CACHE_SIZE = int(os.environ.get("LINK_CACHE_SIZE", 10000))
+LINK_CACHE_TTL = int(os.environ.get("LINK_CACHE_TTL", 600))
+LINK_CACHE_NEGATIVE_TTL = 30
+link_cache = TTLCache(maxsize=LINK_CACHE_SIZE, ttl=LINK_CACHE_TTL)
+_link_lookups_in_flight = {}
+
+async def resolve_link(file_id_str: str):
+    """
+    Resolves a deep-link ID to its record in db.links (or None).
+    Results are shared through link_cache, and concurrent lookups of the same ID share one query.
+    """
+    cached = link_cache.get(file_id_str)
+    if cached is not None:
+        return None if cached is LINK_NOT_FOUND else cached
+
+    pending = _link_lookups_in_flight.get(file_id_str)
+    if pending is None:
+        async def lookup():
+            record = await find_link({"_id": file_id_str})
+            link_cache.set(file_id_str, record or LINK_NOT_FOUND, ttl=None if record else LINK_CACHE_NEGATIVE_TTL)
+            return record
+
+        pending = asyncio.ensure_future(lookup())
+        _link_lookups_in_flight[file_id_str] = pending
+        pending.add_done_callback(lambda _: _link_lookups_in_flight.pop(file_id_str, None))
+    return await asyncio.shield(pending)
+
+def invalidate_link(file_id_str: str):
+    """Drops a deep-link ID from the record cache after it was deleted."""
+    link_cache.pop(file_id_str)
+
+# --- Links Collection ---
+# Single files and bundles live in one collection, db.links, told apart by `type`:
+#   file:   {_id, type, user_id, file_name, file_type, message_id, force_channel, created_at}
+#   bundle: {_id, type, user_id, file_name, message_ids, force_channel, created_at}
+# Records still in the legacy db.files / db.multi_files collections are found through a fallback
+# until the migration has copied them over. It starts in the background at every startup until it
+# has completed once (see auto_migrate_links); admins can also re-run it with /migrate_links.
+LINK_TYPE_FILE = "file"
+LINK_TYPE_BUNDLE = "bundle"
+LINK_NOT_FOUND = object() # Cached marker for IDs that do not exist
+
+async def find_link(query: dict):
+    """Finds one link record, falling back to the legacy collections until the migration is done."""
+    record = await db.links.find_one(query)
+    if record is None and not settings_snapshot.links_migrated:
+        file_record, multi_file_record = await asyncio.gather(db.files.find_one(query), db.multi_files.find_one(query))
+        if file_record:
+            record = {**file_record, "type": LINK_TYPE_FILE}
+        elif multi_file_record:
+            record = {**multi_file_record, "type": LINK_TYPE_BUNDLE}
+    return record
+
+async def delete_link(link_record: dict):
+    file_id_str = link_record['_id']
+    # Remove any legacy copy first, so a migration batch that re-creates the link after the
+    # delete below sees the legacy record gone and undoes it
+    await asyncio.gather(db.files.delete_one({"_id": file_id_str}), db.multi_files.delete_one({"_id": file_id_str}))
+    result = await db.links.delete_one({"_id": file_id_str})
+    if result.deleted_count:
+        await record_link_deleted(link_record)
+    invalidate_link(file_id_str)
+    inline_search_cache.invalidate(link_record['user_id'])
+
+async def migrate_legacy_links(on_progress=None, batch_size: int = 500) -> int:
+    """
+    Online migration of db.files and db.multi_files into db.links. Runs in _id-ordered batches with
+    idempotent upserts, so it can run while the bot serves traffic and can be safely re-run.
+    """
+    migrated = 0
+    for legacy_collection, link_type in ((db.files, LINK_TYPE_FILE), (db.multi_files, LINK_TYPE_BUNDLE)):
+        last_id = None
+        while True:
+            query = {"_id": {"$gt": last_id}} if last_id is not None else {}
+            batch = await legacy_collection.find(query, sort=[("_id", 1)], limit=batch_size)
+            if not batch:
+                break
+            await db.links.bulk_write([
+                UpdateOne(
+                    {"_id": doc["_id"]},
+                    {"$setOnInsert": {
+                        **{k: v for k, v in doc.items() if k != "_id"},
+                        "type": link_type,
+                        "tokens": search_tokens(doc.get("file_name")),
+                        "tokens_version": SEARCH_TOKENS_VERSION
+                    }},
+                    upsert=True
+                )
+                for doc in batch
+            ], ordered=False)
+            # A link deleted while this batch was in flight may have just been re-created; undo that
+            batch_ids = [doc["_id"] for doc in batch]
+            remaining = {doc["_id"] for doc in await legacy_collection.find({"_id": {"$in": batch_ids}}, {"_id": 1})}
+            deleted_ids = [doc_id for doc_id in batch_ids if doc_id not in remaining]
+            if deleted_ids:
+                await db.links.delete_many({"_id": {"$in": deleted_ids}})
+                for doc_id in deleted_ids:
+                    invalidate_link(doc_id)
+            last_id = batch[-1]["_id"]
+            migrated += len(batch)
+            if on_progress:
+                await on_progress(migrated)
+
+    await db.settings.update_one(
+        {"_id": "links_migration"},
+        {"$set": {"done": True, "migrated": migrated, "finished_at": datetime.utcnow()}},
+        upsert=True
+    )
+    settings_snapshot.apply("links_migration", {"done": True})
+    return migrated
+
+async def auto_migrate_links():
+    """Startup task: migrates legacy records so /myfiles and search see them, unless already done."""
+    if settings_snapshot.links_migrated:
+        return
+    try:
+        migrated = await migrate_legacy_links()
+    except Exception as e:
+        logger.error(f"Automatic links migration failed; it is retried at the next start: {e}", exc_info=True)
+        return
+    logger.info(f"🔀 Migrated {migrated} legacy records into the links collection.")
+    # Totals built at startup before the migration only counted db.links
+    try:
+        await rebuild_stats_totals()
+    except Exception as e:
+        logger.error(f"Failed to rebuild statistics after the links migration: {e}")
+
+# --- Search Index ---
+# Every link stores the normalised words of its file name in `tokens`. With the (user_id, tokens)
+# multikey index, each query word becomes an anchored prefix match that Mongo answers from the index,
+# instead of an unanchored case-insensitive regex over every file name.
+SEARCH_PAGE_SIZE = 10
+SEARCH_CANDIDATES = 100 # Most recent matches considered for ranking
+
+SEARCH_TOKENS_VERSION = 2 # Bump when search_tokens changes; existing links are re-tokenised at startup
+
+def fold_text(text: str) -> str:
+    """Compatibility-normalises text, drops combining marks (accents) and casefolds it. Keeps every script."""
+    if text.isascii():
+        return text.casefold()
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch)).casefold()
+
+def split_words(folded: str) -> list:
+    """Splits folded text into runs of letters, digits and marks (so Devanagari vowel signs stay in their word)."""
+    if folded.isascii():
+        return re.findall(r"[a-z0-9]+", folded)
+    return "".join(ch if unicodedata.category(ch)[0] in "LNM" else " " for ch in folded).split()
+
+def search_tokens(text: str) -> list:
+    """Folds text and splits it into unique words, in any script."""
+    if not text:
+        return []
+    return list(dict.fromkeys(split_words(fold_text(text))))
+
+async def find_search_candidates(user_id: int, terms: list) -> list:
+    """Returns a user's most recent links whose tokens start with every query term."""
+    return await db.links.find(
+        {"user_id": user_id, "$and": [{"tokens": {"$regex": f"^{re.escape(term)}"}} for term in terms]},
+        sort=[("created_at", -1)],
+        limit=SEARCH_CANDIDATES
+    )
+
+def rank_search_results(records: list, terms: list) -> list:
+    """Orders matches by how many terms match a whole word, then by recency."""
+    def score(record):
+        tokens = record.get("tokens", [])
+        return (sum(1 for term in terms if term in tokens), record["created_at"])
+    return sorted(records, key=score, reverse=True)
+
+def matches_terms(record: dict, terms: list) -> bool:
+    """In-memory equivalent of the find_search_candidates filter."""
+    tokens = record.get("tokens", [])
+    return all(any(token.startswith(term) for token in tokens) for term in terms)
+
+async def backfill_search_tokens(batch_size: int = 500) -> int:
+    """(Re-)tokenises links created before the search index existed or by an older search_tokens."""
+    updated = 0
+    while True:
+        batch = await db.links.find(
+            {"tokens_version": {"$ne": SEARCH_TOKENS_VERSION}}, {"file_name": 1}, limit=batch_size
+        )
+        if not batch:
+            break
+        await db.links.bulk_write([
+            UpdateOne({"_id": doc["_id"]}, {"$set": {
+                "tokens": search_tokens(doc.get("file_name")), "tokens_version": SEARCH_TOKENS_VERSION
+            }})
+            for doc in batch
+        ], ordered=False)
+        updated += len(batch)
+    await db.settings.update_one(
+        {"_id": "search_index"}, {"$set": {"tokens_version": SEARCH_TOKENS_VERSION}}, upsert=True
+    )
+    return updated
+
+async def ensure_search_tokens():
+    """Runs backfill_search_tokens once after search_tokens changed (tracked in db.settings)."""
+    marker = await db.settings.find_one({"_id": "search_index"})
+    if marker and marker.get("tokens_version") == SEARCH_TOKENS_VERSION:
+        return
+    try:
+        updated = await backfill_search_tokens()
+    except Exception as e:
+        logger.error(f"Search token backfill failed: {e}", exc_info=True)
+        return
+    logger.info(f"🔍 Re-tokenised {updated} links for search index version {SEARCH_TOKENS_VERSION}.")
+
+# --- Inline Query Cache ---
+# Telegram sends an inline query for every character typed. Ranked results are cached per user
+# and normalised query. A query that extends a cached query whose result set was complete
+# (fewer than SEARCH_CANDIDATES matches) is answered by filtering that set in memory. Only cache
+# misses reach Mongo, after a short debounce, and a newer query from the same user cancels the
+# one still waiting or running.
+INLINE_CACHE_TTL = 60
+INLINE_CACHE_PER_USER = 20
+INLINE_DEBOUNCE_SECONDS = 0.25
+
+class InlineSearchCache:
+    """Per-user cache of ranked search results, keyed by the normalised query."""
+
+    def __init__(self, ttl: float, per_user: int, max_users: int = 10000):
+        self.ttl = ttl
+        self.per_user = per_user
+        self.hits = 0
+        self.prefix_hits = 0
+        self.misses = 0
+        self._users = TTLCache(maxsize=max_users, ttl=ttl)
+
+    def lookup(self, user_id: int, key: str):
+        """Returns (records, exact) for the query or its longest complete cached prefix, else (None, False)."""
+        now = time.monotonic()
+        best_key, best_records = None, None
+        for cached_key, (stored_at, records, complete) in (self._users.get(user_id) or {}).items():
+            if now - stored_at > self.ttl:
+                continue
+            if cached_key == key:
+                self.hits += 1
+                return records, True
+            if complete and key.startswith(cached_key) and (best_key is None or len(cached_key) > len(best_key)):
+                best_key, best_records = cached_key, records
+        if best_records is not None:
+            self.prefix_hits += 1
+        else:
+            self.misses += 1
+        return best_records, False
+
+    def store(self, user_id: int, key: str, records: list, complete: bool):
+        entries = self._users.get(user_id) or OrderedDict()
+        entries[key] = (time.monotonic(), records, complete)
+        entries.move_to_end(key)
+        while len(entries) > self.per_user:
+            entries.popitem(last=False)
+        self._users.set(user_id, entries)
+
+    def invalidate(self, user_id: int):
+        """Forgets a user's results after they add or delete a link."""
+        self._users.pop(user_id)
+
+    def stats_text(self) -> str:
+        return f"{self.hits} hits / {self.prefix_hits} prefix hits / {self.misses} misses, {len(self._users)} users"
+
+inline_search_cache = InlineSearchCache(ttl=INLINE_CACHE_TTL, per_user=INLINE_CACHE_PER_USER)
+_inline_searches_in_flight = {}
+
+async def cached_inline_search(user_id: int, terms: list):
+    """Returns ranked links for the query terms, or None if a newer query from the same user superseded it."""
+    key = " ".join(terms)
+    records, exact = inline_search_cache.lookup(user_id, key)
+    if records is not None:
+        if exact:
+            return records
+        ranked = rank_search_results([r for r in records if matches_terms(r, terms)], terms)
+        inline_search_cache.store(user_id, key, ranked, complete=True)
+        return ranked
+
+    previous = _inline_searches_in_flight.get(user_id)
+    if previous:
+        previous.cancel()
+
+    async def search():
+        await asyncio.sleep(INLINE_DEBOUNCE_SECONDS)
+        candidates = await find_search_candidates(user_id, terms)
+        ranked = rank_search_results(candidates, terms)
+        inline_search_cache.store(user_id, key, ranked, complete=len(candidates) < SEARCH_CANDIDATES)
+        return ranked
+
+    task = asyncio.create_task(search())
+    _inline_searches_in_flight[user_id] = task
+    try:
+        await asyncio.wait({task})
+    finally:
+        if _inline_searches_in_flight.get(user_id) is task:
+            del _inline_searches_in_flight[user_id]
+    return None if task.cancelled() else task.result()
+
 # --- Helper Functions (Updated and Enhanced) ---
 
-def generate_random_string(length=8):
-    """Generates a longer and more unique random string."""
-    return ''.join(random.choices(string.ascii_lowercase + string.digits, k=length))
+class LinkIdGenerator:
+    """
+    Snowflake-style link IDs: 41 bits of milliseconds since LINK_ID_EPOCH, a 10-bit worker ID and a
+    12-bit per-millisecond sequence, encoded in base62. IDs are unique across files and bundles
+    by construction, so no pre-check query is needed. Each bot process claims its own
+    worker ID from db.counters at startup. The IDs are 10+ characters, so they can never clash with
+    the 8-character random IDs issued previously.
+    """
 
-async def get_unique_id(collection):
-    """Generates a unique ID and checks if it exists in the collection to avoid DuplicateKeyError."""
-    # Use a slightly longer ID for better uniqueness
-    for _ in range(10): # Try a few times
-        random_id = generate_random_string()
-        if collection.find_one({"_id": random_id}) is None:
-            return random_id
-        await asyncio.sleep(0.01) # Small pause
-    raise Exception("Failed to generate unique ID after multiple attempts.")
+    ALPHABET = string.digits + string.ascii_lowercase + string.ascii_uppercase
+    WORKER_BITS = 10
+    SEQUENCE_BITS = 12
+
+    def __init__(self, epoch: datetime):
+        self.epoch_ms = int(epoch.timestamp() * 1000)
+        self.worker_id = None
+        self._last_ms = -1
+        self._sequence = 0
+
+    async def assign_worker(self):
+        counter = await db.counters.find_one_and_update(
+            {"_id": "link_id_worker"},
+            {"$inc": {"seq": 1}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        self.worker_id = counter["seq"] % (1 << self.WORKER_BITS)
+        logger.info(f"🆔 Link ID worker {self.worker_id} assigned.")
+
+    def _encode(self, number: int) -> str:
+        chars = []
+        while number:
+            number, rem = divmod(number, len(self.ALPHABET))
+            chars.append(self.ALPHABET[rem])
+        return ''.join(reversed(chars))
+
+    def next_id(self) -> str:
+        if self.worker_id is None:
+            raise RuntimeError("LinkIdGenerator.assign_worker() must be awaited before generating IDs.")
+        # Never move backwards if the system clock does
+        now_ms = max(int(time.time() * 1000), self._last_ms)
+        if now_ms == self._last_ms:
+            self._sequence = (self._sequence + 1) % (1 << self.SEQUENCE_BITS)
+            if self._sequence == 0: # Sequence exhausted for this millisecond
+                while now_ms <= self._last_ms:
+                    now_ms = int(time.time() * 1000)
+        else:
+            self._sequence = 0
+        self._last_ms = now_ms
+        snowflake = ((now_ms - self.epoch_ms) << (self.WORKER_BITS + self.SEQUENCE_BITS)) \
+            | (self.worker_id << self.SEQUENCE_BITS) | self._sequence
+        return self._encode(snowflake)
+
+link_ids = LinkIdGenerator(epoch=datetime(2024, 1, 1, tzinfo=timezone.utc))
 
 async def get_user_full_name(user):
     """Safely gets the user's full name, prioritizing First Name."""
@@ -110,41 +746,127 @@ async def get_user_full_name(user):
         return full_name.strip() if full_name else f"User_{user.id}"
     return "Unknown User"
 
-async def is_user_member_all_channels(client: Client, user_id: int, channels: list) -> list:
-    """Checks user membership in a list of channels and returns missing ones."""
-    missing_channels = []
+# Membership answers are cached per (user, channel). "Not a member" expires quickly because
+# the user is expected to join and tap "Try Again" right after being told to.
+MEMBERSHIP_CACHE_TTL = int(os.environ.get("MEMBERSHIP_CACHE_TTL", 300))
+MEMBERSHIP_NEGATIVE_TTL = int(os.environ.get("MEMBERSHIP_NEGATIVE_TTL", 10))
+membership_cache = TTLCache(maxsize=50000, ttl=MEMBERSHIP_CACHE_TTL)
+# Channel username (lowercase) -> resolved chat ID; get_chat runs once per channel per process.
+resolved_channels = {}
+
+async def resolve_channel(client: Client, channel: str):
+    """Resolves a public channel username once and returns its chat ID, or None if the username does not match."""
+    key = channel.lower()
+    if key in resolved_channels:
+        return resolved_channels[key]
+    chat = await client.get_chat(chat_id=f"@{channel}")
+    resolved_channels[key] = chat.id if chat.username and chat.username.lower() == key else None
+    return resolved_channels[key]
+
+async def is_user_member(client: Client, user_id: int, channel: str, recheck_missing: bool = False) -> bool:
+    """Checks (and caches) whether a user is a member of one channel."""
+    cache_key = (user_id, channel.lower())
+    cached = membership_cache.get(cache_key)
+    if cached is True or (cached is False and not recheck_missing):
+        return cached
+
+    is_member = False
+    try:
+        chat_id = await resolve_channel(client, channel)
+        if chat_id is None:
+            is_member = True # Username does not match the resolved chat, nothing to enforce
+        else:
+            member = await client.get_chat_member(chat_id=chat_id, user_id=user_id)
+            is_member = member.status not in (enums.ChatMemberStatus.BANNED, enums.ChatMemberStatus.LEFT)
+    except UserNotParticipant:
+        pass
+    except Exception as e:
+        # Only log severe errors, not common ones like chat not found
+        if "CHAT_NOT_FOUND" not in str(e):
+            logger.error(f"Error checking membership for {user_id} in @{channel}: {e}")
+        return False # Don't cache transient failures
+
+    membership_cache.set(cache_key, is_member, ttl=None if is_member else MEMBERSHIP_NEGATIVE_TTL)
+    return is_member
+
+async def is_user_member_all_channels(client: Client, user_id: int, channels: list, recheck_missing: bool = False) -> list:
+    """Checks user membership in a list of channels concurrently and returns missing ones."""
     if not channels:
         return []
-    for channel in channels:
+    channels = list(set(channels))
+    results = await asyncio.gather(*(is_user_member(client, user_id, ch, recheck_missing) for ch in channels))
+    return [ch for ch, is_member in zip(channels, results) if not is_member]
+
+class SettingsSnapshot:
+    """
+    In-memory copy of the global settings documents (bot_mode, start_photo) so hot paths never
+    read db.settings. It is kept current by a Mongo change stream, or by polling when the server
+    does not support change streams (e.g. a standalone local mongod).
+    """
+
+    KEYS = ("bot_mode", "start_photo", "links_migration")
+
+    def __init__(self, poll_interval: int = 30):
+        self.poll_interval = poll_interval
+        self.bot_mode = "public"
+        self.start_photo = None
+        self.links_migrated = False
+        self._loop = None
+
+    def apply(self, doc_id, doc):
+        """Applies one settings document; a missing document resets the value to its default."""
+        if doc_id == "bot_mode":
+            self.bot_mode = (doc or {}).get("mode", "public")
+        elif doc_id == "start_photo":
+            self.start_photo = (doc or {}).get("file_id") or None
+        elif doc_id == "links_migration":
+            self.links_migrated = bool((doc or {}).get("done"))
+
+    async def reload(self):
+        docs = {doc["_id"]: doc for doc in await db.settings.find({"_id": {"$in": list(self.KEYS)}})}
+        for key in self.KEYS:
+            self.apply(key, docs.get(key))
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        await self.reload()
+        Thread(target=self._watch, name="settings-watch", daemon=True).start()
+
+    def _watch(self):
+        """Blocking change-stream consumer, run in its own thread so it never holds a Mongo worker."""
+        pipeline = [{"$match": {"documentKey._id": {"$in": list(self.KEYS)}}}]
         try:
-            # Check if the chat exists before checking membership
-            chat = await client.get_chat(chat_id=f"@{channel}")
-            if chat.username and chat.username.lower() == channel.lower():
-                 member = await client.get_chat_member(chat_id=f"@{channel}", user_id=user_id)
-                 if member.status in ["kicked", "left"]:
-                     missing_channels.append(channel)
-        except UserNotParticipant:
-            missing_channels.append(channel)
+            with db.settings.sync.watch(pipeline, full_document="updateLookup") as stream:
+                logger.info("⚙️ Watching settings through a change stream.")
+                for change in stream:
+                    self._loop.call_soon_threadsafe(self.apply, change["documentKey"]["_id"], change.get("fullDocument"))
+        except OperationFailure as e:
+            logger.warning(f"Settings change stream unavailable ({e}), polling every {self.poll_interval}s instead.")
+            asyncio.run_coroutine_threadsafe(self._poll(), self._loop)
         except Exception as e:
-            # Only log severe errors, not common ones like chat not found
-            if "CHAT_NOT_FOUND" not in str(e):
-                 logger.error(f"Error checking membership for {user_id} in @{channel}: {e}")
-            missing_channels.append(channel)
-    return list(set(missing_channels)) # Return unique missing channels
-
-async def get_bot_mode(db) -> str:
-    """Fetches the current bot operation mode."""
-    setting = db.settings.find_one({"_id": "bot_mode"})
-    if setting:
-        return setting.get("mode", "public")
-    db.settings.update_one({"_id": "bot_mode"}, {"$set": {"mode": "public"}}, upsert=True)
-    return "public"
+            logger.error(f"Settings change stream stopped: {e}, falling back to polling.")
+            asyncio.run_coroutine_threadsafe(self._poll(), self._loop)
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.reload()
+            except Exception as e:
+                logger.error(f"Failed to refresh settings snapshot: {e}")
+
+settings_snapshot = SettingsSnapshot(poll_interval=int(os.environ.get("SETTINGS_POLL_INTERVAL", 30)))
+
+def get_bot_mode() -> str:
+    """Returns the current bot operation mode from the settings snapshot."""
+    return settings_snapshot.bot_mode
 
 def force_join_check(func):
     """
     Decorator to check if a user is a member of all required channels.
     This is improved to handle complex deep-linking scenarios.
     """
+    @functools.wraps(func)
     async def wrapper(client, message):
         user_id = message.from_user.id
         
@@ -165,13 +887,10 @@ def force_join_check(func):
 
         # Note: /create_link and /multi_link are handled within their respective handlers
         if file_id_str and file_id_str != 'force': # 'force' is a generic check fallback
-            file_record = db.files.find_one({"_id": file_id_str})
-            multi_file_record = db.multi_files.find_one({"_id": file_id_str})
+            link_record = await resolve_link(file_id_str)
             
-            if file_record and file_record.get('force_channel'):
-                all_channels_to_check.append(file_record['force_channel'])
-            elif multi_file_record and multi_file_record.get('force_channel'):
-                all_channels_to_check.append(multi_file_record['force_channel'])
+            if link_record and link_record.get('force_channel'):
+                all_channels_to_check.append(link_record['force_channel'])
         
         all_channels_to_check = list(set(all_channels_to_check))
         missing_channels = await is_user_member_all_channels(client, user_id, all_channels_to_check)
@@ -191,53 +910,1453 @@ def force_join_check(func):
             return
         
         # Before returning, update user activity
-        db.users.update_one(
-             {"_id": user_id},
-             {"$set": {"last_activity": datetime.utcnow()}},
-             upsert=True
-        )
+        activity_tracker.touch(user_id)
         
         return await func(client, message)
     return wrapper
 
-async def delete_files_after_delay(client: Client, chat_id: int, message_ids: list):
-    """Deletes a list of messages after a 60-minute delay."""
-    await asyncio.sleep(3600)  # Wait for 60 minutes (1 hour)
+# --- Auto-Delete Scheduler ---
+# Delivered files are queued in Mongo instead of one sleeping task per delivery, so pending
+# deletions cost no memory and survive restarts. The TTL index on delete_at also drops entries
+# that are older than Telegram's 48-hour deletion window and can no longer be processed.
+AUTO_DELETE_DELAY = 3600 # 60 minutes
+DELETION_TTL_SECONDS = 48 * 3600
+DELETE_BATCH_SIZE = 100 # Telegram's limit for delete_messages
+
+async def schedule_deletion(chat_id: int, message_ids: list, delay: int = AUTO_DELETE_DELAY):
+    """Queues messages for auto-deletion after `delay` seconds."""
+    if not message_ids:
+        return
+    await db.scheduled_deletions.insert_one({
+        "chat_id": chat_id,
+        "message_ids": list(message_ids),
+        "delete_at": datetime.utcnow() + timedelta(seconds=delay)
+    })
+
+class DeletionScheduler:
+    """Single loop that drains due entries from db.scheduled_deletions, batching per chat."""
+
+    def __init__(self, interval: int = 15, fetch_limit: int = 1000):
+        self.interval = interval
+        self.fetch_limit = fetch_limit
+        self._task = None
+
+    async def start(self, client: Client):
+        self._task = asyncio.create_task(self._run(client))
+
+    async def _run(self, client: Client):
+        while True:
+            try:
+                drained = await self.drain(client)
+            except Exception as e:
+                logger.error(f"Auto-delete scheduler error: {e}", exc_info=True)
+                drained = 0
+            # Keep going immediately while there is a backlog (e.g. after a restart)
+            if drained < self.fetch_limit:
+                await asyncio.sleep(self.interval)
+
+    async def drain(self, client: Client) -> int:
+        """Deletes every due message once and returns how many queue entries were processed."""
+        due = await db.scheduled_deletions.find(
+            {"delete_at": {"$lte": datetime.utcnow()}},
+            sort=[("delete_at", 1)],
+            limit=self.fetch_limit
+        )
+        by_chat = {}
+        for entry in due:
+            entry_ids, message_ids = by_chat.setdefault(entry["chat_id"], ([], []))
+            entry_ids.append(entry["_id"])
+            message_ids.extend(entry["message_ids"])
+
+        done_entry_ids = []
+        for chat_id, (entry_ids, message_ids) in by_chat.items():
+            try:
+                for i in range(0, len(message_ids), DELETE_BATCH_SIZE):
+                    await self._delete_batch(client, chat_id, message_ids[i:i + DELETE_BATCH_SIZE])
+                done_entry_ids.extend(entry_ids)
+            except FloodWait as e:
+                # Leave this chat's entries queued; they are retried on the next pass
+                logger.warning(f"FloodWait of {e.value}s while auto-deleting in {chat_id}.")
+                record_flood_wait("auto_delete", e.value)
+                await asyncio.sleep(e.value)
+
+        if done_entry_ids:
+            await db.scheduled_deletions.delete_many({"_id": {"$in": done_entry_ids}})
+        return len(due)
+
+    async def _delete_batch(self, client: Client, chat_id: int, message_ids: list):
+        try:
+            await client.delete_messages(chat_id=chat_id, message_ids=message_ids)
+            logger.info(f"Successfully auto-deleted {len(message_ids)} messages for user {chat_id}.")
+        except FloodWait:
+            raise
+        except Exception as e:
+            # Ignore "Message not found" errors, and don't retry anything else forever
+            if "MESSAGE_NOT_FOUND" not in str(e):
+                logger.error(f"Failed to auto-delete messages {message_ids} for user {chat_id}: {e}")
+
+deletion_scheduler = DeletionScheduler()
+
+# --- Rate Limiting ---
+
+class TokenBucket:
+    """
+    Async token bucket: `rate` tokens per second, bursting up to `capacity`. With a `min_rate` below
+    `rate`, slow_down() halves the rate (down to min_rate) and speed_up() wins back a tenth of the
+    full rate at most every `recovery_interval` seconds, staying below 90% of the rate that last
+    caused a FloodWait for `ceiling_ttl` seconds.
+    """
+
+    def __init__(self, rate: float, capacity: float, min_rate: float = None,
+                 recovery_interval: float = 5, ceiling_ttl: float = 600):
+        self.rate = self.max_rate = rate
+        self.min_rate = rate if min_rate is None else min_rate
+        self.recovery_interval = recovery_interval
+        self.ceiling_ttl = ceiling_ttl
+        self.capacity = capacity
+        self._rate_changed = 0.0
+        self._ceiling = rate
+        self._ceiling_until = 0.0
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        if now > self._updated: # Still in the future while the bucket is blocked
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    async def acquire(self, tokens: float = 1, reserve: float = 0):
+        """Waits for `tokens`. A `reserve` leaves that many tokens for callers that pass none."""
+        while True:
+            now = time.monotonic()
+            if now < self._blocked_until:
+                await asyncio.sleep(self._blocked_until - now)
+                continue
+            self._refill()
+            if self._tokens >= tokens + reserve:
+                self._tokens -= tokens
+                return
+            await asyncio.sleep((tokens + reserve - self._tokens) / self.rate)
+
+    def block_for(self, seconds: float):
+        """Pauses the bucket, e.g. for the duration of a FloodWait."""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0
+        self._updated = max(self._updated, self._blocked_until) # No refill, and so no burst, while blocked
+
+    def slow_down(self):
+        """Halves the rate, once per FloodWait: sends already in flight fail with the same one."""
+        now = time.monotonic()
+        if now < self._rate_changed:
+            return
+        self._refill()
+        self._ceiling = max(self.min_rate, self.rate * 0.9)
+        self._ceiling_until = now + self.ceiling_ttl
+        self.rate = max(self.min_rate, self.rate / 2)
+        self._rate_changed = max(now, self._blocked_until)
+
+    def speed_up(self):
+        now = time.monotonic()
+        limit = self._ceiling if now < self._ceiling_until else self.max_rate
+        if self.rate < limit and now - self._rate_changed >= self.recovery_interval:
+            self._refill()
+            self.rate = min(limit, self.rate + self.max_rate / 10)
+            self._rate_changed = now
+
+# --- Bundle Delivery Engine ---
+# Telegram allows short bursts per chat and roughly 30 messages/sec per bot. Sends are paced by
+# a per-chat and a global token bucket and slowed down only when Telegram answers with FloodWait.
+# The bot's own log channels get a faster bucket of their own (LOG_CHANNEL_RATE) that halves its
+# rate on every FloodWait and recovers with each successful send. Background sends (bundle copies,
+# log flushes) leave BACKGROUND_SEND_RESERVE tokens in both buckets, so a user's single-file
+# upload is not queued behind other users' bundles.
+DELIVERY_CHAT_RATE = float(os.environ.get("DELIVERY_CHAT_RATE", 3))
+DELIVERY_CHAT_BURST = float(os.environ.get("DELIVERY_CHAT_BURST", 5))
+DELIVERY_GLOBAL_RATE = float(os.environ.get("DELIVERY_GLOBAL_RATE", 25))
+LOG_CHANNEL_RATE = float(os.environ.get("LOG_CHANNEL_RATE", 10))
+LOG_CHANNEL_BURST = float(os.environ.get("LOG_CHANNEL_BURST", 10))
+LOG_CHANNEL_MIN_RATE = 1
+BACKGROUND_SEND_RESERVE = 2
+MEDIA_GROUP_LIMIT = 10 # Telegram's maximum album size
+GET_MESSAGES_LIMIT = 200 # Telegram's maximum for one get_messages call
+
+global_send_bucket = TokenBucket(rate=DELIVERY_GLOBAL_RATE, capacity=DELIVERY_GLOBAL_RATE)
+chat_send_buckets = TTLCache(maxsize=20000, ttl=300)
+log_channel_buckets = {
+    chat_id: TokenBucket(rate=LOG_CHANNEL_RATE, capacity=LOG_CHANNEL_BURST, min_rate=LOG_CHANNEL_MIN_RATE)
+    for chat_id in (LOG_CHANNEL, GROUP_LOG_CHANNEL) if chat_id
+}
+
+def get_chat_bucket(chat_id: int) -> TokenBucket:
+    if chat_id in log_channel_buckets:
+        return log_channel_buckets[chat_id]
+    bucket = chat_send_buckets.get(chat_id)
+    if bucket is None:
+        bucket = TokenBucket(rate=DELIVERY_CHAT_RATE, capacity=DELIVERY_CHAT_BURST)
+    chat_send_buckets.set(chat_id, bucket) # Refresh the TTL while the chat is active
+    return bucket
+
+async def send_with_flood_control(chat_id: int, send, max_attempts: int = 3, background: bool = False):
+    """
+    Runs `send()` after acquiring send tokens, retrying after Telegram's FloodWait instead of fixed sleeps.
+    `background` sends leave BACKGROUND_SEND_RESERVE tokens for interactive ones.
+    """
+    chat_bucket = get_chat_bucket(chat_id)
+    reserve = BACKGROUND_SEND_RESERVE if background else 0
+    for attempt in range(max_attempts):
+        await chat_bucket.acquire(reserve=reserve)
+        await global_send_bucket.acquire(reserve=reserve)
+        flood_token = raise_flood_wait.set(True)
+        try:
+            result = await send()
+            chat_bucket.speed_up()
+            return result
+        except FloodWait as e:
+            logger.warning(f"FloodWait of {e.value}s while sending to {chat_id} (attempt {attempt + 1}).")
+            record_flood_wait("send", e.value)
+            chat_bucket.block_for(e.value)
+            chat_bucket.slow_down()
+            if attempt == max_attempts - 1:
+                raise
+        finally:
+            raise_flood_wait.reset(flood_token)
+
+class DeliveryStats:
+    """Time-to-last-file per bundle size bucket, shown to admins in /stats."""
+
+    BUCKETS = ((10, "1-10"), (50, "11-50"), (None, "51+"))
+
+    def __init__(self):
+        self._samples = {label: [0, 0.0, 0.0] for _, label in self.BUCKETS} # count, total, max
+
+    def record(self, bundle_size: int, seconds: float):
+        label = next(label for limit, label in self.BUCKETS if limit is None or bundle_size <= limit)
+        sample = self._samples[label]
+        sample[0] += 1
+        sample[1] += seconds
+        sample[2] = max(sample[2], seconds)
+
+    def stats_text(self) -> str:
+        lines = [
+            f"  • {label} files: avg `{total / count:.1f}s`, max `{slowest:.1f}s` ({count} bundles)"
+            for label, (count, total, slowest) in self._samples.items() if count
+        ]
+        return "\n".join(lines) if lines else "  • No bundles delivered yet."
+
+delivery_stats = DeliveryStats()
+
+def album_kind(msg: Message):
+    """Returns which album a stored message can join ('visual', 'document', 'audio'), or None."""
+    if msg.empty or msg.reply_markup:
+        return None
+    if msg.photo or msg.video:
+        return "visual"
+    if msg.document:
+        return "document"
+    if msg.audio:
+        return "audio"
+    return None
+
+def to_input_media(msg: Message):
+    caption = {"caption": msg.caption or "", "caption_entities": msg.caption_entities}
+    if msg.photo:
+        return InputMediaPhoto(msg.photo.file_id, **caption)
+    if msg.video:
+        return InputMediaVideo(msg.video.file_id, **caption)
+    if msg.document:
+        return InputMediaDocument(msg.document.file_id, **caption)
+    return InputMediaAudio(msg.audio.file_id, **caption)
+
+def plan_bundle_runs(messages: list) -> list:
+    """Splits stored messages into consecutive runs that can be sent as one album (max 10 each)."""
+    runs = []
+    for msg in messages:
+        kind = album_kind(msg)
+        if runs and kind and runs[-1][0] == kind and len(runs[-1][1]) < MEDIA_GROUP_LIMIT:
+            runs[-1][1].append(msg)
+        else:
+            runs.append((kind, [msg]))
+    return runs
+
+async def deliver_bundle(client: Client, chat_id: int, message_ids: list) -> list:
+    """Delivers a bundle stored in LOG_CHANNEL to a chat, in order, and returns the sent message IDs."""
+    started = time.monotonic()
+    messages = []
+    for i in range(0, len(message_ids), GET_MESSAGES_LIMIT):
+        messages.extend(await client.get_messages(LOG_CHANNEL, message_ids[i:i + GET_MESSAGES_LIMIT]))
+
+    sent_message_ids = []
+    for kind, run in plan_bundle_runs(messages):
+        try:
+            if kind and len(run) > 1:
+                sent = await send_with_flood_control(
+                    chat_id, lambda: client.send_media_group(chat_id, [to_input_media(m) for m in run])
+                )
+                sent_message_ids.extend(m.id for m in sent)
+            elif not run[0].empty:
+                sent = await send_with_flood_control(
+                    chat_id, lambda: client.copy_message(chat_id=chat_id, from_chat_id=LOG_CHANNEL, message_id=run[0].id)
+                )
+                sent_message_ids.append(sent.id)
+            else:
+                logger.error(f"Multi-file message is missing from the log channel for chat {chat_id}.")
+        except Exception as e:
+            logger.error(f"Error sending multi-file messages {[m.id for m in run]}: {e}")
+
+    delivery_stats.record(len(message_ids), time.monotonic() - started)
+    return sent_message_ids
+
+# --- Bundle Ingest Pipeline ---
+INGEST_CONCURRENCY = int(os.environ.get("INGEST_CONCURRENCY", 5))
+INGEST_PROGRESS_INTERVAL = 3 # seconds between status message edits
+
+async def copy_to_log_channel(client: Client, original_message: Message, thumbnail_id: str = None, background: bool = False) -> Message:
+    """
+    Copies a user's file to LOG_CHANNEL, applying a custom thumbnail where Telegram supports it.
+    Bundle copies pass `background=True` so single-file uploads go first.
+    """
+    # Pyrogram only supports 'thumb' for Document, Video, and Audio in copy_message
+    thumb_kwargs = {}
+    if thumbnail_id and (original_message.document or original_message.video or original_message.audio):
+        thumb_kwargs['thumb'] = thumbnail_id
+
+    return await send_with_flood_control(LOG_CHANNEL, lambda: client.copy_message(
+        chat_id=LOG_CHANNEL,
+        from_chat_id=original_message.chat.id,
+        message_id=original_message.id,
+        caption=original_message.caption,
+        reply_markup=original_message.reply_markup,
+        **thumb_kwargs
+    ), background=background)
+
+async def ingest_bundle(client: Client, user_id: int, message_ids: list, thumbnail_id: str = None, on_progress=None) -> dict:
+    """
+    Copies a bundle's source messages to LOG_CHANNEL and returns {source message ID: LOG_CHANNEL message ID}.
+    Sources are fetched with batched get_messages calls and copied by up to INGEST_CONCURRENCY workers.
+    `on_progress(done, total)` is awaited at most every INGEST_PROGRESS_INTERVAL seconds.
+    """
+    originals = []
+    for i in range(0, len(message_ids), GET_MESSAGES_LIMIT):
+        originals.extend(await client.get_messages(user_id, message_ids[i:i + GET_MESSAGES_LIMIT]))
+
+    semaphore = asyncio.Semaphore(INGEST_CONCURRENCY)
+    forwarded = {}
+    done = 0
+    last_progress = time.monotonic()
+
+    async def copy(index, original_message):
+        nonlocal done, last_progress
+        async with semaphore:
+            if original_message.empty:
+                logger.error(f"Bundle message {message_ids[index]} from {user_id} no longer exists.")
+            else:
+                try:
+                    forwarded[original_message.id] = (await copy_to_log_channel(client, original_message, thumbnail_id, background=True)).id
+                except Exception as e:
+                    logger.error(f"Error copying message {original_message.id} for bundle: {e}")
+        done += 1
+        if on_progress and time.monotonic() - last_progress >= INGEST_PROGRESS_INTERVAL:
+            last_progress = time.monotonic()
+            await on_progress(done, len(originals))
+
+    await asyncio.gather(*(copy(i, m) for i, m in enumerate(originals)))
+    return forwarded
+
+# In eager mode every file forwarded during /multi_link is copied to LOG_CHANNEL in the background
+# as soon as it arrives, and its LOG_CHANNEL ID is recorded under `ingested` in the user's state.
+# Each user has their own queue and workers serve users round-robin, so one large bundle does not
+# hold up everyone else's. /done takes the user's not-yet-started copies back and does them itself
+# with ingest_bundle, so it only ever waits for the copies already in flight, not for other users.
+# Anything not ingested (e.g. lost in a restart) is copied at /done too.
+# Copies of a bundle that is restarted or replaced by /create_link are deleted from LOG_CHANNEL
+# (see discard_bundle). Copies of a bundle that is simply abandoned until its session expires
+# (SESSION_TTL) are left behind in LOG_CHANNEL.
+BUNDLE_EAGER_INGEST = os.environ.get("BUNDLE_EAGER_INGEST", "true").lower() == "true"
+
+class BundleIngestQueue:
+    """Background workers that copy bundle files to LOG_CHANNEL while the bundle is being built."""
+
+    def __init__(self, workers: int = INGEST_CONCURRENCY):
+        self.workers = workers
+        self._queues = {} # user_id -> deque of (message, thumbnail_id) not started yet
+        self._ready = asyncio.Queue() # user_ids with queued copies, in round-robin order
+        self._running = {} # user_id -> number of copies in flight
+        self._idle = {} # user_id -> Event set when the user has no copies in flight
+
+    def start(self, client: Client):
+        for _ in range(self.workers):
+            asyncio.create_task(self._worker(client))
+
+    def submit(self, user_id: int, message: Message, thumbnail_id: str = None):
+        if user_id not in self._queues:
+            self._queues[user_id] = deque()
+            self._ready.put_nowait(user_id)
+        self._queues[user_id].append((message, thumbnail_id))
+
+    def take_pending(self, user_id: int) -> list:
+        """Removes and returns the user's copies that no worker has started yet."""
+        return list(self._queues.pop(user_id, ()))
+
+    def qsize(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def wait_for_user(self, user_id: int):
+        """Waits until every copy in flight for this user has finished (or failed)."""
+        if user_id in self._idle:
+            await self._idle[user_id].wait()
+
+    async def _worker(self, client: Client):
+        while True:
+            user_id = await self._ready.get()
+            queue = self._queues.get(user_id)
+            if not queue:
+                continue # Taken back by take_pending()
+            message, thumbnail_id = queue.popleft()
+            if queue:
+                self._ready.put_nowait(user_id) # Back of the line until the other users had a turn
+            else:
+                del self._queues[user_id]
+            self._running[user_id] = self._running.get(user_id, 0) + 1
+            self._idle.setdefault(user_id, asyncio.Event()).clear()
+            try:
+                forwarded = await copy_to_log_channel(client, message, thumbnail_id, background=True)
+                await session_store.record_ingested(user_id, message.id, forwarded.id)
+            except Exception as e:
+                logger.error(f"Eager ingest of message {message.id} from {user_id} failed: {e}")
+            finally:
+                self._running[user_id] -= 1
+                if not self._running[user_id]:
+                    del self._running[user_id]
+                    self._idle.pop(user_id).set()
+
+bundle_ingest_queue = BundleIngestQueue()
+
+async def delete_log_copies(client: Client, log_ids: list):
+    """Best-effort removal of bundle copies from LOG_CHANNEL that will never be part of a link."""
+    for i in range(0, len(log_ids), DELETE_BATCH_SIZE):
+        try:
+            await client.delete_messages(chat_id=LOG_CHANNEL, message_ids=log_ids[i:i + DELETE_BATCH_SIZE])
+        except Exception as e:
+            logger.warning(f"Could not delete {len(log_ids[i:i + DELETE_BATCH_SIZE])} discarded bundle copies: {e}")
+
+async def discard_bundle(client: Client, user_id: int):
+    """Drops the user's bundle in progress (if any): its queued copies and the copies already in LOG_CHANNEL."""
+    bundle_ingest_queue.take_pending(user_id)
+    session = await session_store.get(user_id)
+    if session and session.get("state") == "multi_link" and session.get("ingested"):
+        await delete_log_copies(client, list(session["ingested"].values()))
+
+# --- Broadcast Engine ---
+# Users are streamed from Mongo in _id order, one batch at a time, and sent to by a fixed number of
+# concurrent workers under a global messages/sec budget. The job document in db.broadcasts is
+# checkpointed after every batch, so a broadcast interrupted by a restart resumes where it stopped
+# (at most one batch is re-sent).
+BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", 10))
+BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", 20))
+BROADCAST_BATCH_SIZE = 500
+BROADCAST_PROGRESS_INTERVAL = 10 # seconds between status message edits
+BROADCAST_OUTCOMES = ("success", "blocked", "deactivated", "failed")
+
+broadcast_bucket = TokenBucket(rate=BROADCAST_RATE, capacity=BROADCAST_RATE)
+
+async def send_broadcast_to_user(client: Client, job: dict, user_id: int, max_attempts: int = 3) -> str:
+    """Sends the broadcast to one user and classifies the outcome as one of BROADCAST_OUTCOMES."""
+    for _ in range(max_attempts):
+        await broadcast_bucket.acquire()
+        try:
+            if job["text"]:
+                await client.send_message(chat_id=user_id, text=job["text"], disable_web_page_preview=True)
+            else:
+                await client.copy_message(chat_id=user_id, from_chat_id=job["from_chat_id"], message_id=job["message_id"])
+            return "success"
+        except FloodWait as e:
+            # Slows every worker down, not just this one, then retries the same user
+            record_flood_wait("broadcast", e.value)
+            broadcast_bucket.block_for(e.value)
+        except UserIsBlocked:
+            return "blocked"
+        except InputUserDeactivated:
+            return "deactivated"
+        except Exception as e:
+            logger.warning(f"Broadcast to {user_id} failed: {e}")
+            return "failed"
+    return "failed"
+
+def broadcast_progress_text(job: dict, finished: bool = False) -> str:
+    counts = job["counts"]
+    processed = sum(counts.values())
+    header = "✅ **Broadcast Complete!**" if finished else f"⏳ **Broadcasting...** `{processed}/{job['total']}`"
+    return (
+        f"{header}\n\n"
+        f"**Success:** `{counts['success']}`\n"
+        f"**Blocked (Cleaned):** `{counts['blocked']}`\n"
+        f"**Deactivated (Cleaned):** `{counts['deactivated']}`\n"
+        f"**Failed:** `{counts['failed']}`"
+    )
+
+async def update_broadcast_status(client: Client, job: dict, finished: bool = False):
     try:
-        await client.delete_messages(chat_id=chat_id, message_ids=message_ids)
-        logger.info(f"Successfully auto-deleted messages {message_ids} for user {chat_id}.")
+        await client.edit_message_text(job["status_chat_id"], job["status_message_id"], broadcast_progress_text(job, finished))
     except Exception as e:
-        # Ignore "Message not found" errors
-        if "MESSAGE_NOT_FOUND" not in str(e):
-            logger.error(f"Failed to auto-delete messages {message_ids} for user {chat_id}: {e}")
+        logger.warning(f"Could not update broadcast status message: {e}")
+
+async def run_broadcast(client: Client, job: dict):
+    """Runs (or resumes) a broadcast job until every user after its checkpoint has been processed."""
+    semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    last_progress = time.monotonic()
+
+    async def worker(user_id):
+        async with semaphore:
+            return await send_broadcast_to_user(client, job, user_id)
+
+    try:
+        while True:
+            query = {"_id": {"$ne": job["admin_id"]}}
+            if job["last_user_id"] is not None:
+                query["_id"]["$gt"] = job["last_user_id"]
+            batch = [user["_id"] for user in await db.users.find(query, {"_id": 1}, sort=[("_id", 1)], limit=BROADCAST_BATCH_SIZE)]
+            if not batch:
+                break
+
+            outcomes = await asyncio.gather(*(worker(uid) for uid in batch))
+            for outcome in outcomes:
+                job["counts"][outcome] += 1
+            unreachable = [uid for uid, outcome in zip(batch, outcomes) if outcome in ("blocked", "deactivated")]
+            if unreachable:
+                result = await db.users.delete_many({"_id": {"$in": unreachable}})
+                await record_users_removed(result.deleted_count)
+
+            job["last_user_id"] = batch[-1]
+            await db.broadcasts.update_one(
+                {"_id": job["_id"]},
+                {"$set": {"last_user_id": job["last_user_id"], "counts": job["counts"], "updated_at": datetime.utcnow()}}
+            )
+            if time.monotonic() - last_progress >= BROADCAST_PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                await update_broadcast_status(client, job)
+
+        await db.broadcasts.update_one({"_id": job["_id"]}, {"$set": {"status": "done", "finished_at": datetime.utcnow()}})
+        await update_broadcast_status(client, job, finished=True)
+    except Exception as e:
+        logger.error(f"Broadcast {job['_id']} stopped: {e}", exc_info=True)
+
+async def resume_broadcasts(client: Client):
+    """Restarts broadcasts that were still running when the bot last stopped."""
+    for job in await db.broadcasts.find({"status": "running"}):
+        logger.info(f"📣 Resuming broadcast {job['_id']} after user {job['last_user_id']}.")
+        asyncio.create_task(run_broadcast(client, job))
+
+# --- Statistics Rollups ---
+# /stats reads precomputed counters instead of counting collections on every call:
+#   {_id: "totals"}              users, files, bundles, file_types.<type>
+#   {_id: "hour:YYYY-MM-DDTHH"}  uploads, new_users (expire after STATS_HOURLY_RETENTION)
+#   {_id: "day:YYYY-MM-DD"}      uploads, new_users, active_users
+# Counters are incremented as things happen. The totals can be rebuilt from the collections at
+# any time, which also happens at startup if they are missing.
+STATS_HOURLY_RETENTION = timedelta(days=7)
+
+def stats_hour_key(when: datetime) -> str:
+    return f"hour:{when:%Y-%m-%dT%H}"
+
+def stats_day_key(when: datetime) -> str:
+    return f"day:{when:%Y-%m-%d}"
+
+async def bump_stats(totals: dict = None, hourly: dict = None, daily: dict = None):
+    """Applies counter increments to the totals document and the current hourly/daily rollups."""
+    now = datetime.utcnow()
+    hour_start = now.replace(minute=0, second=0, microsecond=0)
+    operations = []
+    if totals:
+        operations.append(UpdateOne({"_id": "totals"}, {"$inc": totals}, upsert=True))
+    if hourly:
+        operations.append(UpdateOne(
+            {"_id": stats_hour_key(now)},
+            {"$inc": hourly, "$setOnInsert": {"start": hour_start, "expires_at": hour_start + STATS_HOURLY_RETENTION}},
+            upsert=True
+        ))
+    if daily:
+        operations.append(UpdateOne(
+            {"_id": stats_day_key(now)},
+            {"$inc": daily, "$setOnInsert": {"start": hour_start.replace(hour=0)}},
+            upsert=True
+        ))
+    if operations:
+        try:
+            await db.stats.bulk_write(operations, ordered=False)
+        except Exception as e:
+            logger.error(f"Failed to update statistics: {e}")
+
+async def record_link_created(link_type: str, file_type: str = None):
+    totals = {"files" if link_type == LINK_TYPE_FILE else "bundles": 1}
+    if file_type:
+        totals[f"file_types.{file_type}"] = 1
+    await bump_stats(totals, hourly={"uploads": 1}, daily={"uploads": 1})
+
+async def record_link_deleted(link_record: dict):
+    totals = {"files" if link_record['type'] == LINK_TYPE_FILE else "bundles": -1}
+    if link_record.get('file_type'):
+        totals[f"file_types.{link_record['file_type']}"] = -1
+    await bump_stats(totals)
+
+async def record_new_users(count: int = 1):
+    if count:
+        await bump_stats({"users": count}, hourly={"new_users": count}, daily={"new_users": count})
+
+async def record_users_removed(count: int):
+    if count:
+        await bump_stats({"users": -count})
+
+async def record_active_users(new_by_day: dict):
+    """Adds users seen for the first time on a UTC day to that day's active_users rollup ({day start: count})."""
+    operations = [
+        UpdateOne({"_id": stats_day_key(day)}, {"$inc": {"active_users": count}, "$setOnInsert": {"start": day}}, upsert=True)
+        for day, count in new_by_day.items() if count
+    ]
+    if operations:
+        try:
+            await db.stats.bulk_write(operations, ordered=False)
+        except Exception as e:
+            logger.error(f"Failed to update active user statistics: {e}")
+
+async def rebuild_stats_totals():
+    """Recomputes the totals document from the collections. Expensive, only run on demand or at bootstrap."""
+    user_count, files_count, bundles_count, file_types = await asyncio.gather(
+        db.users.count_documents({}),
+        db.links.count_documents({"type": LINK_TYPE_FILE}),
+        db.links.count_documents({"type": LINK_TYPE_BUNDLE}),
+        db.links.aggregate([
+            {"$match": {"type": LINK_TYPE_FILE}},
+            {"$group": {"_id": "$file_type", "count": {"$sum": 1}}}
+        ])
+    )
+    await db.stats.update_one(
+        {"_id": "totals"},
+        {"$set": {
+            "users": user_count,
+            "files": files_count,
+            "bundles": bundles_count,
+            "file_types": {ft["_id"]: ft["count"] for ft in file_types if ft["_id"]},
+            "rebuilt_at": datetime.utcnow()
+        }},
+        upsert=True
+    )
+    logger.info("📊 Statistics totals rebuilt.")
+
+async def ensure_stats_totals():
+    if await db.stats.find_one({"_id": "totals"}) is None:
+        await rebuild_stats_totals()
+
+def stats_history_chart(now: datetime, days: dict) -> str:
+    """Text bar chart of uploads and active users for the last 7 days."""
+    rows = []
+    for offset in range(6, -1, -1):
+        day = now - timedelta(days=offset)
+        doc = days.get(stats_day_key(day), {})
+        rows.append((f"{day:%d-%m}", doc.get("uploads", 0), doc.get("active_users", 0)))
+    peak = max((uploads for _, uploads, _ in rows), default=0) or 1
+    return "\n".join(
+        f"`{label}` {'▇' * round(uploads / peak * 10) or '▁'} `{uploads}` · `{active}`"
+        for label, uploads, active in rows
+    )
+
+# --- User Activity Tracking ---
+
+class ActivityTracker:
+    """
+    Write-behind buffer for db.users activity. Updates are coalesced per user in memory and
+    flushed with one unordered bulk_write every `interval` seconds, or sooner once `max_pending`
+    users are waiting. stop() performs a final, time-bounded flush on graceful shutdown.
+    The first touch of a user on each UTC day also queues a db.active_days marker; markers are
+    upserted in the same flush, and the ones that are new count towards the daily active_users.
+    """
+
+    def __init__(self, interval: float = 5, max_pending: int = 5000):
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._active_markers = [] # (day start, user_id) not yet written
+        self._active_day = None
+        self._counted_today = set() # Users already marked today by this process
+        self._task = None
+        self._flush_lock = asyncio.Lock()
+
+    def touch(self, user_id: int, **fields):
+        """Records that a user was active now, optionally updating other profile fields."""
+        now = datetime.utcnow()
+        self._pending.setdefault(user_id, {}).update(fields, last_activity=now)
+        day = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        if self._active_day != day:
+            self._active_day, self._counted_today = day, set()
+        if user_id not in self._counted_today:
+            self._counted_today.add(user_id)
+            self._active_markers.append((day, user_id))
+        if len(self._pending) >= self.max_pending:
+            asyncio.create_task(self.flush())
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def qsize(self) -> int:
+        return len(self._pending)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    async def flush(self):
+        async with self._flush_lock:
+            await self._flush_users()
+            await self._flush_active_markers()
+
+    async def _flush_users(self):
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, {}
+        try:
+            result = await db.users.bulk_write(
+                [UpdateOne({"_id": user_id}, {"$set": fields}, upsert=True) for user_id, fields in batch.items()],
+                ordered=False
+            )
+        except Exception as e:
+            logger.error(f"Failed to flush activity for {len(batch)} users: {e}")
+            # Put the batch back without overwriting anything newer that arrived meanwhile
+            for user_id, fields in batch.items():
+                self._pending[user_id] = {**fields, **self._pending.get(user_id, {})}
+            return
+        await record_new_users(len(result.upserted_ids))
+
+    async def _flush_active_markers(self):
+        if not self._active_markers:
+            return
+        markers, self._active_markers = self._active_markers, []
+        # The markers make the daily count exact across restarts and multiple processes
+        try:
+            result = await db.active_days.bulk_write([
+                UpdateOne(
+                    {"_id": f"{stats_day_key(day)}:{user_id}"},
+                    {"$setOnInsert": {"expires_at": day + timedelta(days=3)}},
+                    upsert=True
+                )
+                for day, user_id in markers
+            ], ordered=False)
+        except Exception as e:
+            logger.error(f"Failed to flush {len(markers)} active-day markers: {e}")
+            self._active_markers = markers + self._active_markers # Upserts are idempotent, safe to retry
+            return
+        new_by_day = {}
+        for index in result.upserted_ids:
+            day = markers[index][0]
+            new_by_day[day] = new_by_day.get(day, 0) + 1
+        await record_active_users(new_by_day)
+
+    async def stop(self, timeout: float = 10):
+        """Final flush on shutdown. A periodic flush that is already writing is allowed to finish first."""
+        async def final_flush():
+            async with self._flush_lock:
+                if self._task:
+                    self._task.cancel()
+            await self.flush()
+
+        try:
+            await asyncio.wait_for(final_flush(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Activity flush timed out on shutdown; {len(self._pending)} users were not saved.")
+
+activity_tracker = ActivityTracker(interval=float(os.environ.get("ACTIVITY_FLUSH_INTERVAL", 5)))
+
+# --- Upload Sessions ---
+# The per-user /create_link and /multi_link workflow state (state, force_channel, file_name,
+# thumbnail_id and the bundle's message_ids/ingested map) lives in its own store instead of
+# db.settings. Reads are served from a write-through in-process cache, and every write goes to the
+# backend too, so a restart only loses what the backend itself has not kept. Sessions that are not
+# touched for SESSION_TTL seconds expire, so an abandoned bundle cleans itself up.
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "mongo").lower() # mongo | redis | memory
+SESSION_TTL = int(os.environ.get("SESSION_TTL", 24 * 3600))
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+
+class MemorySessionBackend:
+    """Keeps sessions only in this process. Nothing survives a restart."""
+
+    def __init__(self, ttl: float):
+        self._sessions = TTLCache(maxsize=1_000_000, ttl=ttl)
+
+    def _touch(self, user_id: int) -> dict:
+        session = self._sessions.get(user_id) or {}
+        self._sessions.set(user_id, session)
+        return session
+
+    async def load(self, user_id: int):
+        session = self._sessions.get(user_id)
+        return {**session, "message_ids": list(session.get("message_ids", [])), "ingested": dict(session.get("ingested", {}))} if session else None
+
+    async def set_fields(self, user_id: int, fields: dict):
+        self._touch(user_id).update(fields)
+
+    async def start_bundle(self, user_id: int, fields: dict):
+        self._touch(user_id).update(fields, message_ids=[], file_count=0, ingested={})
+
+    async def unset_field(self, user_id: int, field: str) -> bool:
+        session = self._sessions.get(user_id)
+        if not session or field not in session:
+            return False
+        del session[field]
+        return True
+
+    async def push_message(self, user_id: int, message_id: int) -> int:
+        session = self._touch(user_id)
+        session.setdefault("message_ids", []).append(message_id)
+        session["file_count"] = len(session["message_ids"])
+        return session["file_count"]
+
+    async def set_ingested(self, user_id: int, src_id: int, log_id: int):
+        session = self._sessions.get(user_id)
+        if session and session.get("state") == "multi_link":
+            session.setdefault("ingested", {})[str(src_id)] = log_id
+
+    async def delete(self, user_id: int):
+        self._sessions.pop(user_id)
+
+class MongoSessionBackend:
+    """Stores one document per user in db.sessions; a TTL index on updated_at expires idle sessions."""
+
+    def __init__(self, collection: AsyncCollection):
+        self.collection = collection
+
+    async def load(self, user_id: int):
+        return await self.collection.find_one({"_id": user_id}, {"_id": 0, "updated_at": 0})
+
+    async def set_fields(self, user_id: int, fields: dict):
+        await self.collection.update_one(
+            {"_id": user_id}, {"$set": {**fields, "updated_at": datetime.utcnow()}}, upsert=True
+        )
+
+    async def start_bundle(self, user_id: int, fields: dict):
+        await self.set_fields(user_id, {**fields, "message_ids": [], "file_count": 0, "ingested": {}})
+
+    async def unset_field(self, user_id: int, field: str) -> bool:
+        result = await self.collection.update_one(
+            {"_id": user_id, field: {"$exists": True}},
+            {"$unset": {field: ""}, "$set": {"updated_at": datetime.utcnow()}}
+        )
+        return result.modified_count > 0
+
+    async def push_message(self, user_id: int, message_id: int) -> int:
+        # $inc returns the new count in the same round-trip without shipping message_ids back
+        session = await self.collection.find_one_and_update(
+            {"_id": user_id},
+            {"$push": {"message_ids": message_id}, "$inc": {"file_count": 1}, "$set": {"updated_at": datetime.utcnow()}},
+            projection={"file_count": 1, "_id": 0},
+            return_document=ReturnDocument.AFTER
+        )
+        return session.get("file_count", 0) if session else 0
+
+    async def set_ingested(self, user_id: int, src_id: int, log_id: int):
+        await self.collection.update_one(
+            {"_id": user_id, "state": "multi_link"}, {"$set": {f"ingested.{src_id}": log_id}}
+        )
+
+    async def delete(self, user_id: int):
+        await self.collection.delete_one({"_id": user_id})
+
+class RedisSessionBackend:
+    """
+    Stores a session as three Redis keys: a hash of JSON-encoded scalar fields, a list of bundle
+    message IDs and a hash of ingested IDs. Every write refreshes the expiry of all three.
+    """
+
+    def __init__(self, url: str, ttl: int):
+        self.redis = aioredis.from_url(url, decode_responses=True)
+        self.ttl = ttl
+
+    @staticmethod
+    def _keys(user_id: int):
+        return f"session:{user_id}", f"session:{user_id}:messages", f"session:{user_id}:ingested"
+
+    def _expire(self, pipe, user_id: int):
+        for key in self._keys(user_id):
+            pipe.expire(key, self.ttl)
+
+    async def load(self, user_id: int):
+        fields_key, messages_key, ingested_key = self._keys(user_id)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.hgetall(fields_key)
+            pipe.lrange(messages_key, 0, -1)
+            pipe.hgetall(ingested_key)
+            fields, message_ids, ingested = await pipe.execute()
+        if not fields:
+            return None
+        session = {name: json.loads(value) for name, value in fields.items()}
+        session["message_ids"] = [int(message_id) for message_id in message_ids]
+        session["file_count"] = len(session["message_ids"])
+        session["ingested"] = {src_id: int(log_id) for src_id, log_id in ingested.items()}
+        return session
+
+    async def set_fields(self, user_id: int, fields: dict):
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(self._keys(user_id)[0], mapping={name: json.dumps(value) for name, value in fields.items()})
+            self._expire(pipe, user_id)
+            await pipe.execute()
+
+    async def start_bundle(self, user_id: int, fields: dict):
+        fields_key, messages_key, ingested_key = self._keys(user_id)
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.delete(messages_key, ingested_key)
+            pipe.hset(fields_key, mapping={name: json.dumps(value) for name, value in fields.items()})
+            self._expire(pipe, user_id)
+            await pipe.execute()
+
+    async def unset_field(self, user_id: int, field: str) -> bool:
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hdel(self._keys(user_id)[0], field)
+            self._expire(pipe, user_id)
+            results = await pipe.execute()
+        return results[0] > 0
+
+    async def push_message(self, user_id: int, message_id: int) -> int:
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.rpush(self._keys(user_id)[1], message_id)
+            self._expire(pipe, user_id)
+            results = await pipe.execute()
+        return results[0]
+
+    async def set_ingested(self, user_id: int, src_id: int, log_id: int):
+        fields_key, _, ingested_key = self._keys(user_id)
+        # Same guard as the other backends; an expired session must not get a key without expiry
+        state = await self.redis.hget(fields_key, "state")
+        if state is None or json.loads(state) != "multi_link":
+            return
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(ingested_key, str(src_id), log_id)
+            self._expire(pipe, user_id)
+            await pipe.execute()
+
+    async def delete(self, user_id: int):
+        await self.redis.delete(*self._keys(user_id))
+
+class SessionStore:
+    """Write-through cache in front of a session backend. get() returns a copy the caller may modify."""
+
+    def __init__(self, backend, ttl: float, maxsize: int = 10000):
+        self.backend = backend
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def get(self, user_id: int):
+        session = self._cache.get(user_id)
+        if session is None:
+            session = await self.backend.load(user_id)
+            if session is None:
+                return None
+            self._cache.set(user_id, session)
+        return {**session, "message_ids": list(session.get("message_ids", [])), "ingested": dict(session.get("ingested", {}))}
+
+    async def update(self, user_id: int, **fields):
+        """Sets scalar fields (state, force_channel, file_name, thumbnail_id), creating the session if needed."""
+        await self.backend.set_fields(user_id, fields)
+        session = self._cache.get(user_id)
+        if session is not None:
+            session.update(fields)
+            self._cache.set(user_id, session)
+
+    async def start_bundle(self, user_id: int, **fields):
+        """Switches the user into /multi_link mode with an empty bundle."""
+        fields = {**fields, "state": "multi_link"}
+        await self.backend.start_bundle(user_id, fields)
+        session = self._cache.get(user_id) or {}
+        session.update(fields, message_ids=[], file_count=0, ingested={})
+        self._cache.set(user_id, session)
+
+    async def unset(self, user_id: int, field: str) -> bool:
+        """Removes one field. Returns whether it was set."""
+        removed = await self.backend.unset_field(user_id, field)
+        session = self._cache.get(user_id)
+        if session is not None:
+            session.pop(field, None)
+        return removed
+
+    async def add_bundle_message(self, user_id: int, message_id: int) -> int:
+        """Appends a file to the user's bundle and returns the new file count."""
+        count = await self.backend.push_message(user_id, message_id)
+        session = self._cache.get(user_id)
+        if session is not None:
+            session.setdefault("message_ids", []).append(message_id)
+            session["file_count"] = count
+        return count
+
+    async def record_ingested(self, user_id: int, src_id: int, log_id: int):
+        """Records the LOG_CHANNEL copy of a bundle file, if the user is still building a bundle."""
+        await self.backend.set_ingested(user_id, src_id, log_id)
+        session = self._cache.get(user_id)
+        if session is not None and session.get("state") == "multi_link":
+            session.setdefault("ingested", {})[str(src_id)] = log_id
+
+    async def clear(self, user_id: int):
+        self._cache.pop(user_id)
+        await self.backend.delete(user_id)
+
+if SESSION_BACKEND == "redis":
+    if aioredis is None:
+        logger.error("❌ SESSION_BACKEND is 'redis' but the redis package is not installed.")
+        exit()
+    session_backend = RedisSessionBackend(REDIS_URL, SESSION_TTL)
+elif SESSION_BACKEND == "memory":
+    session_backend = MemorySessionBackend(SESSION_TTL)
+else:
+    session_backend = MongoSessionBackend(db.sessions)
+session_store = SessionStore(session_backend, ttl=SESSION_TTL)
+
+# --- Log Channel Sink ---
+# Handlers post log entries here and return immediately. A background task drains the bounded queue
+# every LOG_FLUSH_INTERVAL seconds and packs consecutive entries for the same channel into as few
+# messages as Telegram's 4096-character limit allows. Entries that do not fit in the queue, or that
+# could not be sent, are appended to LOG_SPILL_FILE and replayed on the next flush. While a flush
+# replays the spill file it is renamed to `<LOG_SPILL_FILE>.processing`, and only removed once every
+# entry in it was sent or re-spilled, so a crash mid-flush re-sends rather than loses them.
+# An entry is dropped after LOG_SPILL_MAX_ATTEMPTS failed sends, or when the spill file is full.
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 1000))
+LOG_FLUSH_INTERVAL = float(os.environ.get("LOG_FLUSH_INTERVAL", 3))
+LOG_SPILL_FILE = os.environ.get("LOG_SPILL_FILE", "log_spill.jsonl")
+LOG_SPILL_MAX_BYTES = int(os.environ.get("LOG_SPILL_MAX_BYTES", 10 * 1024 * 1024))
+LOG_SPILL_MAX_ATTEMPTS = int(os.environ.get("LOG_SPILL_MAX_ATTEMPTS", 5))
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+class LogSink:
+    """Bounded, batched writer for LOG_CHANNEL / GROUP_LOG_CHANNEL entries with a disk spill file."""
+
+    def __init__(self, queue_size: int, interval: float, spill_path: str,
+                 max_spill_bytes: int = LOG_SPILL_MAX_BYTES, max_attempts: int = LOG_SPILL_MAX_ATTEMPTS):
+        self.interval = interval
+        self.spill_path = spill_path
+        self.processing_path = f"{spill_path}.processing"
+        self.max_spill_bytes = max_spill_bytes
+        self.max_attempts = max_attempts
+        self.sent = 0
+        self.spilled = 0
+        self.dropped = 0
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._task = None
+        self._flush_lock = asyncio.Lock()
+
+    def post(self, chat_id: int, text: str):
+        """Queues a log entry without waiting for it to be delivered."""
+        if not chat_id:
+            return
+        try:
+            self._queue.put_nowait((chat_id, text, 0))
+        except asyncio.QueueFull:
+            self._spill([(chat_id, text, 0)])
+
+    def qsize(self) -> int:
+        return self._queue.qsize()
+
+    def _spill(self, entries: list):
+        """Appends (chat_id, text, failed_attempts) entries to the spill file, dropping what cannot be kept."""
+        kept = [entry for entry in entries if entry[2] < self.max_attempts]
+        if len(kept) < len(entries):
+            self.dropped += len(entries) - len(kept)
+            logger.error(f"Dropped {len(entries) - len(kept)} log entries after {self.max_attempts} failed sends.")
+        if not kept:
+            return
+        try:
+            if os.path.exists(self.spill_path) and os.path.getsize(self.spill_path) >= self.max_spill_bytes:
+                self.dropped += len(kept)
+                logger.error(f"Dropped {len(kept)} log entries; {self.spill_path} is full.")
+                return
+            with open(self.spill_path, "a", encoding="utf-8") as spill_file:
+                for entry in kept:
+                    spill_file.write(json.dumps(list(entry)) + "\n")
+            self.spilled += len(kept)
+        except OSError as e:
+            self.dropped += len(kept)
+            logger.error(f"Dropped {len(kept)} log entries; could not write {self.spill_path}: {e}")
+
+    def _take_spilled(self) -> list:
+        """
+        Moves the spill file aside and returns its entries. A `.processing` file left by a crash is
+        replayed first; a spill file written meanwhile is then picked up by the next flush.
+        """
+        try:
+            if not os.path.exists(self.processing_path):
+                os.replace(self.spill_path, self.processing_path)
+            with open(self.processing_path, encoding="utf-8") as spill_file:
+                entries = [json.loads(line) for line in spill_file if line.strip()]
+            return [(entry[0], entry[1], entry[2] if len(entry) > 2 else 0) for entry in entries]
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not replay {self.processing_path}: {e}")
+            return []
+
+    def _finish_spilled(self):
+        try:
+            os.remove(self.processing_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Could not remove {self.processing_path}: {e}")
+
+    @staticmethod
+    def _pack(entries: list) -> list:
+        """
+        Joins (text, failed_attempts) entries into messages of at most TELEGRAM_MESSAGE_LIMIT characters.
+        A message carries the highest attempt count of the entries in it.
+        """
+        messages, current, attempts = [], "", 0
+        for text, entry_attempts in entries:
+            text = text[:TELEGRAM_MESSAGE_LIMIT]
+            if current and len(current) + 2 + len(text) > TELEGRAM_MESSAGE_LIMIT:
+                messages.append((current, attempts))
+                current, attempts = "", 0
+            current = f"{current}\n\n{text}" if current else text
+            attempts = max(attempts, entry_attempts)
+        if current:
+            messages.append((current, attempts))
+        return messages
+
+    def start(self, client: Client):
+        self._task = asyncio.create_task(self._run(client))
+
+    async def _run(self, client: Client):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush(client)
+
+    async def flush(self, client: Client):
+        async with self._flush_lock:
+            entries = self._take_spilled() # Older than anything still in the queue
+            while not self._queue.empty():
+                entries.append(self._queue.get_nowait())
+            by_chat = {}
+            for chat_id, text, attempts in entries:
+                by_chat.setdefault(chat_id, []).append((text, attempts))
+            pending = [(chat_id, text, attempts) for chat_id, chat_entries in by_chat.items()
+                       for text, attempts in self._pack(chat_entries)]
+
+            failed_chats = set()
+            try:
+                while pending:
+                    chat_id, text, attempts = pending[0]
+                    if chat_id in failed_chats:
+                        self._spill([(chat_id, text, attempts + 1)])
+                    else:
+                        try:
+                            await send_with_flood_control(
+                                chat_id, lambda: client.send_message(chat_id, text, disable_web_page_preview=True),
+                                background=True
+                            )
+                            self.sent += 1
+                        except Exception as e:
+                            logger.error(f"Failed to write to log channel {chat_id}, spilling its remaining messages: {e}")
+                            failed_chats.add(chat_id)
+                            self._spill([(chat_id, text, attempts + 1)])
+                    pending.pop(0)
+            finally:
+                # Also reached when the flush is cancelled: keep whatever was not sent yet
+                if pending:
+                    self._spill(pending)
+                self._finish_spilled()
+
+    async def stop(self, client: Client, timeout: float = 10):
+        """
+        Final flush on shutdown. A periodic flush that is already sending is allowed to finish first.
+        Whatever cannot be sent in time stays in the spill file.
+        """
+        async def final_flush():
+            async with self._flush_lock:
+                if self._task:
+                    self._task.cancel()
+            await self.flush(client)
+
+        try:
+            await asyncio.wait_for(final_flush(), timeout)
+        except asyncio.TimeoutError:
+            logger.error("Log flush timed out on shutdown.")
+            if self._task:
+                # A periodic flush still stuck sending spills what it has left when cancelled
+                self._task.cancel()
+                await asyncio.gather(self._task, return_exceptions=True)
+        pending = []
+        while not self._queue.empty():
+            pending.append(self._queue.get_nowait())
+        if pending:
+            self._spill(pending)
+
+log_sink = LogSink(LOG_QUEUE_SIZE, LOG_FLUSH_INTERVAL, LOG_SPILL_FILE)
+
+# --- Group Moderation ---
+# BADWORDS are compiled once into a single alternation regex. Messages are normalised the same way
+# as the word list (folded like search tokens, so every script is kept, with leetspeak mapped back
+# to letters), so "Fuck" and "b1tch" match, and each message is scanned in one pass. Leetspeak is
+# only mapped in tokens with at least two letters, so "8c" or "50" are never rewritten. Words are
+# delimited by whitespace after splitting, so matching works for scripts where \b does not.
+# A second pass catches stretched words ("fuuuck"): only words with a run of 3+ identical letters
+# are collapsed and compared against the collapsed word list, which leaves out entries of 3 letters
+# or fewer. "kuta", "book", "bcc" or "burr" therefore never match.
+# Warnings are kept per (chat, user) in db.warnings and expire after WARNING_TTL_DAYS without a new one.
+MODERATION_ACTION = os.environ.get("MODERATION_ACTION", "mute").lower() # mute | ban
+MUTE_DURATION = int(os.environ.get("MUTE_DURATION", 24 * 3600)) # seconds
+WARNING_TTL_DAYS = int(os.environ.get("WARNING_TTL_DAYS", 30))
+LEET_TABLE = str.maketrans({"0": "o", "1": "i", "3": "e", "4": "a", "5": "s", "7": "t", "8": "b", "@": "a", "$": "s"})
+LEET_CHARS = re.compile("[" + re.escape("".join(map(chr, LEET_TABLE))) + "]")
+LEET_MIN_LETTERS = 2 # Tokens with fewer letters ("8c", "50") are left as they are
+REPEATED_RUN = re.compile(r"(.)\1+")
+STRETCHED_RUN = re.compile(r"(.)\1{2,}")
+COLLAPSE_MIN_LENGTH = 4 # Shorter entries ("bc", "mc", "bur") are too easy to hit by collapsing
+
+def leet_to_letters(token: str) -> str:
+    """Maps leetspeak digits/symbols to letters, unless the token has fewer than LEET_MIN_LETTERS letters."""
+    if sum(ch.isalpha() for ch in token) < LEET_MIN_LETTERS:
+        return token
+    return token.translate(LEET_TABLE)
+
+def normalise_for_moderation(text: str) -> list:
+    """Folds text, maps leetspeak per whitespace-separated token and splits it into words."""
+    folded = fold_text(text)
+    if LEET_CHARS.search(folded):
+        folded = " ".join(leet_to_letters(token) for token in folded.split())
+    return split_words(folded)
+
+def collapse_repeats(word: str) -> str:
+    return REPEATED_RUN.sub(r"\1", word)
+
+def compile_badwords(words: list):
+    """
+    Builds one regex for the normalised word list (longest first) and the set of collapsed
+    single-word entries of at least COLLAPSE_MIN_LENGTH letters. Returns (None, set()) if the list is empty.
+    """
+    normalised = sorted({" ".join(normalise_for_moderation(word)) for word in words} - {""}, key=len, reverse=True)
+    if not normalised:
+        return None, set()
+    pattern = re.compile(r"(?<!\S)(?:" + "|".join(map(re.escape, normalised)) + r")(?!\S)")
+    return pattern, {collapse_repeats(word) for word in normalised if " " not in word and len(word) >= COLLAPSE_MIN_LENGTH}
+
+BADWORDS_PATTERN, COLLAPSED_BADWORDS = compile_badwords(BADWORDS)
+
+def find_badword(text: str):
+    """
+    Returns the normalised form of the first bad word in text, or None. A match from the
+    stretched-word pass says which word it was collapsed from.
+    """
+    if not BADWORDS_PATTERN or not text:
+        return None
+    words = normalise_for_moderation(text)
+    match = BADWORDS_PATTERN.search(" ".join(words))
+    if match:
+        return match.group()
+    for word in words:
+        if STRETCHED_RUN.search(word):
+            collapsed = collapse_repeats(word)
+            if collapsed in COLLAPSED_BADWORDS:
+                return f"{collapsed} (collapsed from {word})"
+    return None
+
+async def add_warning(chat_id: int, user_id: int) -> int:
+    """Adds a warning for the user in this chat and returns their new warning count."""
+    record = await db.warnings.find_one_and_update(
+        {"_id": f"{chat_id}:{user_id}"},
+        {
+            "$inc": {"count": 1},
+            "$set": {"chat_id": chat_id, "user_id": user_id, "expires_at": datetime.utcnow() + timedelta(days=WARNING_TTL_DAYS)}
+        },
+        projection={"count": 1, "_id": 0},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return record["count"]
+
+async def reset_warnings(chat_id: int, user_id: int):
+    await db.warnings.delete_one({"_id": f"{chat_id}:{user_id}"})
+
+async def punish_user(client: Client, chat_id: int, user_id: int) -> str:
+    """Applies MODERATION_ACTION to a user who reached MAX_WARNINGS. Returns a description of what was done."""
+    if MODERATION_ACTION == "ban":
+        await client.ban_chat_member(chat_id, user_id)
+        return "banned"
+    await client.restrict_chat_member(
+        chat_id, user_id, ChatPermissions(can_send_messages=False),
+        until_date=datetime.now(timezone.utc) + timedelta(seconds=MUTE_DURATION)
+    )
+    return f"muted for {MUTE_DURATION // 3600} hours" if MUTE_DURATION >= 3600 else f"muted for {MUTE_DURATION} seconds"
+
+# Side-effects of removing a message are batched so a spam raid does not cost three RPCs per message.
+# Removals are collected per chat for MODERATION_BATCH_DELAY seconds, then deleted with one
+# delete_messages call and announced with a single notice. Log entries are posted to GROUP_LOG_CHANNEL
+# as a digest every MODERATION_DIGEST_INTERVAL seconds.
+MODERATION_BATCH_DELAY = float(os.environ.get("MODERATION_BATCH_DELAY", 2))
+MODERATION_DIGEST_INTERVAL = float(os.environ.get("MODERATION_DIGEST_INTERVAL", 60))
+DIGEST_MAX_LINES = 30
+LINK_ENTITY_TYPES = (enums.MessageEntityType.URL, enums.MessageEntityType.TEXT_LINK, enums.MessageEntityType.TEXT_MENTION)
+
+class ModerationQueue:
+    """Per-chat batches of removed messages plus the pending log digest. Counts RPCs per removed message."""
+
+    def __init__(self, batch_delay: float, digest_interval: float):
+        self.batch_delay = batch_delay
+        self.digest_interval = digest_interval
+        self.removed = 0
+        self.rpcs = 0
+        self._chats = {} # chat_id -> {"message_ids": [...], "notices": [...], "alerts": [...]}
+        self._digest = []
+        self._digest_running = False
+
+    def start(self):
+        if GROUP_LOG_CHANNEL:
+            self._digest_running = True
+            asyncio.create_task(self._digest_loop())
+
+    def record_rpc(self, count: int = 1):
+        """Counts RPCs spent on moderation, including ones made by the handler (e.g. restricting a user)."""
+        self.rpcs += count
+
+    def qsize(self) -> int:
+        return sum(len(batch["message_ids"]) for batch in self._chats.values())
+
+    def remove(self, client: Client, message: Message, notice: str, log_line: str, alert: str = None):
+        """
+        Queues a message for deletion. `notice` is shown if it is the only removal in its batch,
+        `alert` (e.g. a user being muted) is always shown, and `log_line` goes into the digest.
+        """
+        batch = self._chats.get(message.chat.id)
+        if batch is None:
+            batch = self._chats[message.chat.id] = {"message_ids": [], "notices": [], "alerts": []}
+            asyncio.create_task(self._flush_chat_later(client, message.chat.id))
+        batch["message_ids"].append(message.id)
+        batch["notices"].append(notice)
+        if alert:
+            batch["alerts"].append(alert)
+        if self._digest_running:
+            self._digest.append(log_line)
+        self.removed += 1
+
+    async def _flush_chat_later(self, client: Client, chat_id: int):
+        await asyncio.sleep(self.batch_delay)
+        batch = self._chats.pop(chat_id)
+        message_ids = batch["message_ids"]
+        try:
+            for i in range(0, len(message_ids), DELETE_BATCH_SIZE):
+                chunk = message_ids[i:i + DELETE_BATCH_SIZE]
+                self.record_rpc()
+                await send_with_flood_control(chat_id, lambda: client.delete_messages(chat_id, chunk))
+        except ChatAdminRequired:
+            logger.warning(f"Cannot delete messages in {chat_id}: the bot is not an admin there.")
+            return
+        except Exception as e:
+            logger.error(f"Failed to delete {len(message_ids)} messages in {chat_id}: {e}")
+
+        if len(message_ids) == 1:
+            notice = batch["alerts"][0] if batch["alerts"] else batch["notices"][0]
+        else:
+            notice = "\n".join([f"🚫 **{len(message_ids)} messages removed** (links or abusive language)."] + batch["alerts"])
+        try:
+            self.record_rpc()
+            await send_with_flood_control(chat_id, lambda: client.send_message(chat_id, notice))
+        except Exception as e:
+            logger.error(f"Failed to send moderation notice to {chat_id}: {e}")
+
+    async def _digest_loop(self):
+        while True:
+            await asyncio.sleep(self.digest_interval)
+            if not self._digest:
+                continue
+            entries, self._digest = self._digest, []
+            lines = entries[-DIGEST_MAX_LINES:]
+            if len(entries) > len(lines):
+                lines.insert(0, f"…and {len(entries) - len(lines)} earlier actions")
+            self.record_rpc()
+            log_sink.post(GROUP_LOG_CHANNEL, f"🛡️ **Moderation Digest:** {len(entries)} actions\n\n" + "\n".join(lines))
+
+    def stats_text(self) -> str:
+        if not self.removed:
+            return "  • No messages removed yet."
+        return f"  • Removed **{self.removed}** messages with **{self.rpcs}** RPCs (`{self.rpcs / self.removed:.2f}` per message)"
+
+moderation_queue = ModerationQueue(MODERATION_BATCH_DELAY, MODERATION_DIGEST_INTERVAL)
+
+# --- Index Management ---
+# Every index the bot relies on is declared here and created at startup (create_index is a no-op
+# when the index already exists). The hot queries are then explained with the sort and limit they
+# run with, and any that would still fall back to a collection scan or sort in memory (a blocking
+# SORT stage) are reported in the logs.
+REQUIRED_INDEXES = [
+    # (collection, keys, options)
+    ("links", [("user_id", 1), ("created_at", -1), ("_id", -1)], {}), # /myfiles keyset pagination
+    ("links", [("user_id", 1), ("tokens", 1)], {}), # Inline search
+    ("links", [("type", 1), ("file_type", 1)], {}), # Rebuilding the /stats totals
+    ("stats", [("expires_at", 1)], {"expireAfterSeconds": 0}), # Hourly rollup retention
+    ("active_days", [("expires_at", 1)], {"expireAfterSeconds": 0}),
+    ("scheduled_deletions", [("delete_at", 1)], {"expireAfterSeconds": DELETION_TTL_SECONDS}), # Scheduler + expiry
+    ("broadcasts", [("status", 1)], {}), # Resuming broadcasts
+    ("sessions", [("updated_at", 1)], {"expireAfterSeconds": SESSION_TTL}), # Abandoned upload sessions
+    ("warnings", [("expires_at", 1)], {"expireAfterSeconds": 0}), # Group warning expiry
+]
+
+HOT_QUERIES = [
+    # (description, collection, filter, sort, limit)
+    ("/myfiles listing", "links", {"user_id": 0}, [("created_at", -1), ("_id", -1)], None),
+    ("inline search", "links", {"user_id": 0, "tokens": {"$regex": "^x"}}, [("created_at", -1)], SEARCH_CANDIDATES),
+    ("due auto-deletions", "scheduled_deletions", {"delete_at": {"$lte": datetime(2000, 1, 1)}}, [("delete_at", 1)],
+     deletion_scheduler.fetch_limit),
+]
+
+def _plan_stages(plan: dict):
+    """Yields every stage name in an explain() plan tree."""
+    if not isinstance(plan, dict):
+        return
+    if "stage" in plan:
+        yield plan["stage"]
+    for key in ("inputStage", "queryPlan"):
+        yield from _plan_stages(plan.get(key))
+    for child in plan.get("inputStages", []):
+        yield from _plan_stages(child)
+
+async def ensure_indexes():
+    for collection_name, keys, options in REQUIRED_INDEXES:
+        try:
+            await getattr(db, collection_name).create_index(keys, **options)
+        except Exception as e:
+            logger.error(f"Failed to create index {keys} on {collection_name}: {e}")
+    logger.info(f"🗂️ Ensured {len(REQUIRED_INDEXES)} indexes.")
+
+async def verify_query_plans():
+    """Explains the hot queries and warns about any that use a collection scan or an in-memory sort."""
+    for description, collection_name, query, sort, limit in HOT_QUERIES:
+        try:
+            explain = await getattr(db, collection_name).explain(query, sort=sort, limit=limit or 0)
+            stages = set(_plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {})))
+            if "COLLSCAN" in stages:
+                logger.warning(f"⚠️ Query '{description}' on {collection_name} uses a COLLSCAN. Check REQUIRED_INDEXES.")
+            if "SORT" in stages:
+                logger.warning(f"⚠️ Query '{description}' on {collection_name} sorts in memory (blocking SORT). Check REQUIRED_INDEXES.")
+        except Exception as e:
+            logger.error(f"Could not explain query '{description}': {e}")
 
 # --- Bot Command Handlers (Updated for Style and Logic) ---
 
 @app.on_message(filters.command("start") & filters.private)
+@instrument_handler
 @force_join_check # Force join check is now applied directly to /start
 async def start_handler(client: Client, message: Message):
     user_id = message.from_user.id
     user_name = await get_user_full_name(message.from_user)
     
     # Track user and last activity
-    db.users.update_one(
-        {"_id": user_id}, 
-        {"$set": {"name": user_name, "last_activity": datetime.utcnow()}}, 
-        upsert=True
-    )
+    activity_tracker.touch(user_id, name=user_name)
 
     if len(message.command) > 1:
         file_id_str = message.command[1]
         
-        file_record = db.files.find_one({"_id": file_id_str})
-        multi_file_record = db.multi_files.find_one({"_id": file_id_str})
+        link_record = await resolve_link(file_id_str)
+        file_record = link_record if link_record and link_record['type'] == LINK_TYPE_FILE else None
+        multi_file_record = link_record if link_record and link_record['type'] == LINK_TYPE_BUNDLE else None
         
         # If force_join_check passed, send the file(s)
         if file_record:
             try:
                 sent_message = await client.copy_message(chat_id=user_id, from_chat_id=LOG_CHANNEL, message_id=file_record['message_id'])
                 await message.reply("🎉 **File Unlocked!** It will be auto-deleted in **60 minutes** to save space.", quote=True)
-                asyncio.create_task(delete_files_after_delay(client, user_id, [sent_message.id]))
+                await schedule_deletion(user_id, [sent_message.id])
             except Exception as e:
                 await message.reply(f"❌ An error occurred while sending the file.\n`Error: {e}`")
             return
@@ -249,15 +2368,12 @@ async def start_handler(client: Client, message: Message):
             # Send a confirmation message first
             await message.reply(f"📦 **Bundle Unlocked!** Sending **{file_title}** now. This will be auto-deleted in **60 minutes**.", quote=True)
 
-            for msg_id in multi_file_record['message_ids']:
-                try:
-                    sent_message = await client.copy_message(chat_id=user_id, from_chat_id=LOG_CHANNEL, message_id=msg_id)
-                    sent_message_ids.append(sent_message.id)
-                    await asyncio.sleep(0.5) # Throttle to prevent flooding
-                except Exception as e:
-                    logger.error(f"Error sending multi-file message {msg_id}: {e}")
+            try:
+                sent_message_ids = await deliver_bundle(client, user_id, multi_file_record['message_ids'])
+            except Exception as e:
+                logger.error(f"Error delivering bundle {file_id_str}: {e}", exc_info=True)
             
-            asyncio.create_task(delete_files_after_delay(client, user_id, sent_message_ids))
+            await schedule_deletion(user_id, sent_message_ids)
             return
         
         await message.reply("🤔 **File/Bundle Not Found!** The link might be wrong, expired, or deleted by the owner.")
@@ -269,8 +2385,7 @@ async def start_handler(client: Client, message: Message):
             [InlineKeyboardButton("⚙️ My Files & Settings", callback_data="my_files_menu")]
         ]
         
-        start_photo_id_doc = db.settings.find_one({"_id": "start_photo"})
-        start_photo_id = start_photo_id_doc.get("file_id") if start_photo_id_doc and start_photo_id_doc.get("file_id") else None
+        start_photo_id = settings_snapshot.start_photo
 
         caption_text = (
             f"**Hello, {message.from_user.first_name}! I'm FileLinker Bot!** 🤖\n\n"
@@ -299,6 +2414,7 @@ async def start_handler(client: Client, message: Message):
 
 
 @app.on_message(filters.command("help") & filters.private)
+@instrument_handler
 async def help_handler_private(client: Client, message: Message):
     text = (
         "💡 **FileLinker Bot Usage Guide**\n\n"
@@ -314,16 +2430,17 @@ async def help_handler_private(client: Client, message: Message):
         "   - Reply to a **photo** with: `/set_thumbnail`\n"
         "   - The next file or bundle will use that photo as its thumbnail.\n\n"
         "**4. Management:**\n"
-        "   - **My Files:** `/myfiles` (View your last 10 uploads).\n"
+        "   - **My Files:** `/myfiles` (Browse all your uploads, 10 per page).\n"
         "   - **Delete:** `/delete <file_id>` (Permanently delete your file/bundle).\n\n"
         "**5. Inline Search (Everywhere):**\n"
-        f"   - In any chat, type: `@{(await client.get_me()).username} <file_name>` to search and share links instantly!"
+        f"   - In any chat, type: `@{bot_context.username} <file_name>` to search and share links instantly!"
     )
     await message.reply(text, disable_web_page_preview=True)
 
 # Note: Group Help Handler removed as per request
 
 @app.on_message(filters.command("create_link") & filters.private)
+@instrument_handler
 @force_join_check
 async def create_link_handler(client: Client, message: Message):
     # Check for state clearance for custom name/channel
@@ -333,14 +2450,8 @@ async def create_link_handler(client: Client, message: Message):
         file_name = " ".join(message.command[1:]) if len(message.command) > 1 else None
         
         # Preserve existing thumbnail ID
-        user_state = db.settings.find_one({"_id": message.from_user.id, "type": "temp_link"})
-        thumbnail_id = user_state.get("thumbnail_id") if user_state else None
-            
-        db.settings.update_one(
-            {"_id": message.from_user.id, "type": "temp_link"},
-            {"$set": {"state": "single_link", "force_channel": None, "file_name": file_name, "thumbnail_id": thumbnail_id}},
-            upsert=True
-        )
+        await discard_bundle(client, message.from_user.id)
+        await session_store.update(message.from_user.id, state="single_link", force_channel=None, file_name=file_name)
         await message.reply("Okay! Now send me a **single file** to generate a link.")
         return
         
@@ -360,17 +2471,11 @@ async def create_link_handler(client: Client, message: Message):
             return
         
         # Bot must be a member
-        await client.get_chat_member(chat_id=f"@{force_channel}", user_id=(await client.get_me()).id)
+        await client.get_chat_member(chat_id=f"@{force_channel}", user_id=bot_context.id)
         
         # Preserve existing thumbnail ID
-        user_state = db.settings.find_one({"_id": message.from_user.id, "type": "temp_link"})
-        thumbnail_id = user_state.get("thumbnail_id") if user_state else None
-        
-        db.settings.update_one(
-            {"_id": message.from_user.id, "type": "temp_link"},
-            {"$set": {"state": "single_link", "force_channel": force_channel, "file_name": file_name, "thumbnail_id": thumbnail_id}},
-            upsert=True
-        )
+        await discard_bundle(client, message.from_user.id)
+        await session_store.update(message.from_user.id, state="single_link", force_channel=force_channel, file_name=file_name)
         
         await message.reply(f"✅ Force join channel set to **@{force_channel}**. Now send me a **file** to get its link.")
         
@@ -381,6 +2486,7 @@ async def create_link_handler(client: Client, message: Message):
 
 # --- NEW: Set Thumbnail Handler ---
 @app.on_message(filters.command("set_thumbnail") & filters.private)
+@instrument_handler
 @force_join_check
 async def set_thumbnail_handler(client: Client, message: Message):
     """Sets a temporary thumbnail photo ID for the next file or bundle."""
@@ -396,42 +2502,35 @@ async def set_thumbnail_handler(client: Client, message: Message):
     thumbnail_id = message.reply_to_message.photo.file_id
     
     # Save the thumbnail ID in the user's temporary state
-    # We use 'single_link' as a default state for a fresh temp_link entry, but it's mainly for thumbnail storage
-    db.settings.update_one(
-        {"_id": message.from_user.id, "type": "temp_link"},
-        {"$set": {"thumbnail_id": thumbnail_id, "state": "single_link"}}, # Set state to single link for clarity
-        upsert=True
-    )
+    # We use 'single_link' as a default state for a fresh session, but it's mainly for thumbnail storage
+    await session_store.update(message.from_user.id, thumbnail_id=thumbnail_id, state="single_link")
     
     await message.reply("✅ **Thumbnail Set!**\n\n"
                         "The next file you upload (or the next `/multi_link` bundle) will use this thumbnail. Send `/cancel_thumbnail` to remove it.")
                         
 @app.on_message(filters.command("cancel_thumbnail") & filters.private)
+@instrument_handler
 @force_join_check
 async def cancel_thumbnail_handler(client: Client, message: Message):
     """Cancels the temporary thumbnail."""
     
     # Find and unset the thumbnail ID
-    result = db.settings.update_one(
-        {"_id": message.from_user.id, "type": "temp_link"},
-        {"$unset": {"thumbnail_id": ""}}
-    )
-    
-    if result.modified_count > 0:
+    if await session_store.unset(message.from_user.id, "thumbnail_id"):
          await message.reply("✅ **Custom Thumbnail Cancelled!** Future uploads will use default thumbnails.")
     else:
          await message.reply("❌ No custom thumbnail was set to be cancelled.")
 # ---------------------------------
 
 @app.on_message(filters.private & (filters.document | filters.video | filters.photo | filters.audio))
+@instrument_handler
 @force_join_check
 async def file_handler(client: Client, message: Message):
-    bot_mode = await get_bot_mode(db)
+    bot_mode = get_bot_mode()
     if bot_mode == "private" and message.from_user.id not in ADMINS:
         await message.reply("😔 **Bot is in Private Mode!** Only Admins can upload files right now.")
         return
 
-    user_state = db.settings.find_one({"_id": message.from_user.id, "type": "temp_link"})
+    user_state = await session_store.get(message.from_user.id)
     
     # Get thumbnail ID from state
     thumbnail_id = user_state.get("thumbnail_id") if user_state else None
@@ -445,15 +2544,11 @@ async def file_handler(client: Client, message: Message):
              await message.reply("⚠️ File is too large to be added to the bundle. Max limit is 2GB.", quote=True)
              return
              
-        # Add message ID to the list
-        db.settings.update_one(
-            {"_id": message.from_user.id, "type": "temp_link"},
-            {"$push": {"message_ids": message.id}}
-        )
+        # Add message ID to the bundle and get the new file count back
+        new_count = await session_store.add_bundle_message(message.from_user.id, message.id)
         
-        # Update file count in state for better user feedback
-        new_state = db.settings.find_one({"_id": message.from_user.id, "type": "temp_link"})
-        new_count = len(new_state.get("message_ids", []))
+        if BUNDLE_EAGER_INGEST:
+            bundle_ingest_queue.submit(message.from_user.id, message, thumbnail_id)
         
         await message.reply(f"📦 File **#{new_count}** added to the bundle. Send more or use `/done` to finish.", quote=True)
         return
@@ -462,24 +2557,10 @@ async def file_handler(client: Client, message: Message):
     status_msg = await message.reply("⏳ **Processing File...** Please wait while I create your link. 🔗", quote=True)
     
     try:
-        original_message = message
-        
-        # Determine thumbnail application: Pyrogram only supports 'thumb' for Document, Video, and Audio in copy_message
-        thumb_kwargs = {}
-        if thumbnail_id and (original_message.document or original_message.video or original_message.audio):
-             thumb_kwargs['thumb'] = thumbnail_id
-        
         # Copy the message to the LOG_CHANNEL
-        forwarded_message = await client.copy_message( 
-            chat_id=LOG_CHANNEL, 
-            from_chat_id=message.chat.id, 
-            message_id=message.id,
-            caption=original_message.caption,
-            reply_markup=original_message.reply_markup,
-            **thumb_kwargs
-        ) 
+        forwarded_message = await copy_to_log_channel(client, message, thumbnail_id)
         
-        file_id_str = await get_unique_id(db.files) 
+        file_id_str = link_ids.next_id()
         
         # Determine file name and type
         file_name = "Untitled"
@@ -504,23 +2585,29 @@ async def file_handler(client: Client, message: Message):
         force_channel = user_state.get("force_channel") if user_state and user_state.get("state") == "single_link" else None
         
         # Insert file record
-        db.files.insert_one({
+        await db.links.insert_one({
             '_id': file_id_str,
+            'type': LINK_TYPE_FILE,
             'message_id': forwarded_message.id,
             'user_id': message.from_user.id,
             'file_name': file_name,
             'file_type': file_type,
+            'tokens': search_tokens(file_name),
+            'tokens_version': SEARCH_TOKENS_VERSION,
             'force_channel': force_channel,
             'created_at': datetime.utcnow()
         })
         
+        inline_search_cache.invalidate(message.from_user.id)
+        await record_link_created(LINK_TYPE_FILE, file_type)
+        
         # Clean up temporary state: This also deletes the temporary 'thumbnail_id'
-        db.settings.delete_one({"_id": message.from_user.id, "type": "temp_link"})
+        await session_store.clear(message.from_user.id)
         
-        bot_username = (await client.get_me()).username
-        share_link = f"https://t.me/{bot_username}?start={file_id_str}"
+        share_link = bot_context.share_link(file_id_str)
+        share_text = f"File: {file_name}\nLink: {share_link}"
         
-        share_button = InlineKeyboardButton("📤 Share Link", url=f"https://t.me/share/url?url={urllib.parse.quote(f'File: {file_name}\nLink: {share_link}')}")
+        share_button = InlineKeyboardButton("📤 Share Link", url=f"https://t.me/share/url?url={urllib.parse.quote(share_text)}")
         
         reply_text = (
             f"🎉 **Link Generated Successfully!** 🎉\n\n"
@@ -549,9 +2636,9 @@ async def file_handler(client: Client, message: Message):
         )
         if thumbnail_id:
              log_text += " (🖼️ Custom Thumb)"
-        log_text += f"\n• **Link:** `t.me/{bot_username}?start={file_id_str}`"
+        log_text += f"\n• **Link:** `{bot_context.short_link(file_id_str)}`"
         
-        await client.send_message(LOG_CHANNEL, log_text)
+        log_sink.post(LOG_CHANNEL, log_text)
 
     except Exception as e:
         logger.error(f"Single file handling error: {e}", exc_info=True)
@@ -559,6 +2646,7 @@ async def file_handler(client: Client, message: Message):
 
 
 @app.on_message(filters.command("multi_link") & filters.private)
+@instrument_handler
 @force_join_check
 async def multi_link_handler(client: Client, message: Message):
     # Parse command for force channel and custom title
@@ -573,24 +2661,17 @@ async def multi_link_handler(client: Client, message: Message):
         else:
             file_name = " ".join(command_parts)
     
-    # Preserve thumbnail ID if it exists
-    user_state = db.settings.find_one({"_id": message.from_user.id, "type": "temp_link"})
-    thumbnail_id = user_state.get("thumbnail_id") if user_state else None
-    
     if force_channel:
         try:
             chat = await client.get_chat(force_channel)
             if chat.type != 'channel':
                 await message.reply("❌ That is not a valid **public channel username**.")
                 return
-            await client.get_chat_member(chat_id=f"@{force_channel}", user_id=(await client.get_me()).id)
+            await client.get_chat_member(chat_id=f"@{force_channel}", user_id=bot_context.id)
             
-            # Save state with force channel and existing thumbnail ID
-            db.settings.update_one(
-                {"_id": message.from_user.id, "type": "temp_link"},
-                {"$set": {"state": "multi_link", "message_ids": [], "force_channel": force_channel, "file_name": file_name, "thumbnail_id": thumbnail_id}},
-                upsert=True
-            )
+            # Save state with force channel; an existing thumbnail ID is kept
+            await discard_bundle(client, message.from_user.id)
+            await session_store.start_bundle(message.from_user.id, force_channel=force_channel, file_name=file_name)
             await message.reply(f"✅ Force join channel set to **@{force_channel}**. Now, forward files for the bundle. Send `/done` to finish.")
             return
             
@@ -602,11 +2683,8 @@ async def multi_link_handler(client: Client, message: Message):
             return
 
     # No force channel, just multi-link mode setup
-    db.settings.update_one(
-        {"_id": message.from_user.id, "type": "temp_link"},
-        {"$set": {"state": "multi_link", "message_ids": [], "force_channel": None, "file_name": file_name, "thumbnail_id": thumbnail_id}},
-        upsert=True
-    )
+    await discard_bundle(client, message.from_user.id)
+    await session_store.start_bundle(message.from_user.id, force_channel=None, file_name=file_name)
     
     reply_text = (
         "📦 **Multi-File Bundle Mode Activated!**\n\n"
@@ -614,16 +2692,18 @@ async def multi_link_handler(client: Client, message: Message):
         "When you're finished, send the command `/done`."
     )
     
-    if thumbnail_id:
+    user_state = await session_store.get(message.from_user.id)
+    if user_state and user_state.get("thumbnail_id"):
          reply_text += "\n\n🖼️ **Note:** A custom thumbnail is currently set and will be applied to the files in this bundle (if they are document/video/audio)."
     
     await message.reply(reply_text)
 
 @app.on_message(filters.command("done") & filters.private)
+@instrument_handler
 @force_join_check
 async def done_handler(client: Client, message: Message):
     user_id = message.from_user.id
-    user_state = db.settings.find_one({"_id": user_id, "type": "temp_link"})
+    user_state = await session_store.get(user_id)
     
     if user_state and user_state.get("state") == "multi_link":
         message_ids = user_state.get("message_ids", [])
@@ -636,50 +2716,59 @@ async def done_handler(client: Client, message: Message):
         status_msg = await message.reply(f"⏳ **Finishing Bundle!** Processing {len(message_ids)} files...")
         
         try:
-            forwarded_msg_ids = []
-            for msg_id in message_ids:
+            async def report_progress(done, total):
                 try:
-                    # Get the original message to check file type and caption/markup
-                    original_message = await client.get_messages(user_id, msg_id) 
-                    
-                    thumb_kwargs = {}
-                    if thumbnail_id and (original_message.document or original_message.video or original_message.audio):
-                         thumb_kwargs['thumb'] = thumbnail_id
-                    
-                    # Copy message from the user's chat to the LOG_CHANNEL
-                    forwarded_msg = await client.copy_message(
-                        chat_id=LOG_CHANNEL, 
-                        from_chat_id=user_id, 
-                        message_id=msg_id,
-                        caption=original_message.caption,
-                        reply_markup=original_message.reply_markup,
-                        **thumb_kwargs
-                    ) 
-                    forwarded_msg_ids.append(forwarded_msg.id)
-                    await asyncio.sleep(0.1) 
-                except Exception as e:
-                    logger.error(f"Error copying message {msg_id} for bundle: {e}")
+                    await status_msg.edit_text(f"⏳ **Finishing Bundle!** Copied {done}/{total} files...")
+                except Exception:
+                    pass # Progress updates are best-effort
+
+            forwarded = {}
+            if BUNDLE_EAGER_INGEST:
+                # Copies not started yet are done below by ingest_bundle instead of waiting for a worker
+                bundle_ingest_queue.take_pending(user_id)
+                await bundle_ingest_queue.wait_for_user(user_id)
+                user_state = await session_store.get(user_id) or user_state
+                forwarded = {int(src_id): log_id for src_id, log_id in user_state.get("ingested", {}).items()}
+                # Copies recorded for messages that are not in this bundle (e.g. from a restarted one)
+                bundle_ids = set(message_ids)
+                stray_ids = [log_id for src_id, log_id in forwarded.items() if src_id not in bundle_ids]
+                if stray_ids:
+                    asyncio.create_task(delete_log_copies(client, stray_ids))
+            
+            missing_ids = [msg_id for msg_id in message_ids if msg_id not in forwarded]
+            if missing_ids:
+                forwarded.update(await ingest_bundle(client, user_id, missing_ids, thumbnail_id, on_progress=report_progress))
             
-            multi_file_id = await get_unique_id(db.multi_files) 
+            forwarded_msg_ids = [forwarded[msg_id] for msg_id in message_ids if msg_id in forwarded]
+            if not forwarded_msg_ids:
+                await status_msg.edit_text("❌ **Error!**\n\nNone of the bundle files could be copied. Please try again.")
+                return
+            
+            multi_file_id = link_ids.next_id()
             force_channel = user_state.get("force_channel")
             file_name = user_state.get("file_name") or f"Bundle of {len(forwarded_msg_ids)} Files"
             
-            db.multi_files.insert_one({
+            await db.links.insert_one({
                 '_id': multi_file_id, 
+                'type': LINK_TYPE_BUNDLE,
                 'message_ids': forwarded_msg_ids,
                 'user_id': user_id,
                 'file_name': file_name,
+                'tokens': search_tokens(file_name),
+                'tokens_version': SEARCH_TOKENS_VERSION,
                 'force_channel': force_channel,
                 'created_at': datetime.utcnow()
             })
             
-            bot_username = (await client.get_me()).username
-            share_link = f"https://t.me/{bot_username}?start={multi_file_id}"
+            inline_search_cache.invalidate(user_id)
+            await record_link_created(LINK_TYPE_BUNDLE)
+            share_link = bot_context.share_link(multi_file_id)
+            share_text = f"Bundle: {file_name}\nLink: {share_link}"
             
             # Clean up temporary state: This also deletes the temporary 'thumbnail_id'
-            db.settings.delete_one({"_id": user_id, "type": "temp_link"})
+            await session_store.clear(user_id)
             
-            share_button = InlineKeyboardButton("📤 Share Bundle Link", url=f"https://t.me/share/url?url={urllib.parse.quote(f'Bundle: {file_name}\nLink: {share_link}')}")
+            share_button = InlineKeyboardButton("📤 Share Bundle Link", url=f"https://t.me/share/url?url={urllib.parse.quote(share_text)}")
             
             reply_text = (
                 f"🎉 **Multi-File Bundle Link Generated!** 🎉\n\n"
@@ -708,9 +2797,9 @@ async def done_handler(client: Client, message: Message):
             )
             if thumbnail_id:
                  log_text += " (🖼️ Custom Thumb)"
-            log_text += f"\n• **Link:** `t.me/{bot_username}?start={multi_file_id}`"
+            log_text += f"\n• **Link:** `{bot_context.short_link(multi_file_id)}`"
             
-            await client.send_message(LOG_CHANNEL, log_text)
+            log_sink.post(LOG_CHANNEL, log_text)
 
         except Exception as e:
             logger.error(f"Multi-file link creation error: {e}", exc_info=True)
@@ -719,44 +2808,93 @@ async def done_handler(client: Client, message: Message):
         await message.reply("🤔 You are not in multi-link mode. Send `/multi_link [Optional Title]` to start a new bundle.")
 
 
-@app.on_message(filters.command("myfiles") & filters.private)
-async def my_files_handler(client: Client, message: Message):
-    user_id = message.from_user.id
+MY_FILES_PAGE_SIZE = 10
+_EPOCH = datetime(1970, 1, 1)
+
+def encode_my_files_cursor(link_record: dict) -> str:
+    """Encodes a (created_at, _id) keyset position for callback data."""
+    created_ms = (link_record['created_at'] - _EPOCH) // timedelta(milliseconds=1)
+    return f"{created_ms}_{link_record['_id']}"
+
+async def build_my_files_page(user_id: int, direction: str = "next", cursor: str = None):
+    """
+    Returns (text, keyboard) for one page of a user's files and bundles, or (None, None) if they have none.
+    Pages use keyset pagination on (created_at, _id), newest first, so every page costs one indexed query.
+    """
+    query = {"user_id": user_id}
+    if cursor:
+        created_ms, last_id = cursor.split("_", 1)
+        created_at = _EPOCH + timedelta(milliseconds=int(created_ms))
+        op = "$lt" if direction == "next" else "$gt"
+        query["$or"] = [{"created_at": {op: created_at}}, {"created_at": created_at, "_id": {op: last_id}}]
+
+    order = -1 if direction == "next" else 1
+    user_links = await db.links.find(
+        query,
+        {"tokens": 0},
+        sort=[("created_at", order), ("_id", order)],
+        limit=MY_FILES_PAGE_SIZE + 1 # One extra record tells us whether another page exists
+    )
+    has_more = len(user_links) > MY_FILES_PAGE_SIZE
+    user_links = user_links[:MY_FILES_PAGE_SIZE]
+    if direction == "prev":
+        user_links.reverse()
+        has_newer, has_older = has_more, True
+    else:
+        has_newer, has_older = cursor is not None, has_more
+
+    if not user_links:
+        return None, None
+
+    text = "📂 **Your Uploads & Bundles:**\n\n"
     
-    # Fetch last 5 single files and last 5 multi-files
-    user_single_files = list(db.files.find({"user_id": user_id}).sort("created_at", -1).limit(5))
-    user_multi_files = list(db.multi_files.find({"user_id": user_id}).sort("created_at", -1).limit(5))
+    for i, link_record in enumerate(user_links):
+        file_id_str = link_record['_id']
+        share_link = bot_context.share_link(file_id_str)
+        if link_record['type'] == LINK_TYPE_BUNDLE:
+            file_name = link_record.get('file_name', f"Bundle of {len(link_record.get('message_ids', []))} Files")
+            text += f"**{i+1}.** `📦` [{file_name}]({share_link}) — `{file_id_str}`\n"
+        else:
+            file_name = link_record.get('file_name', 'Unnamed File')
+            text += f"**{i+1}.** `🔗` [{file_name}]({share_link}) — `{file_id_str}`\n"
+    text += "\n"
+
+    text += "_To delete a file, use: `/delete <file_id>`_"
+
+    nav_buttons = []
+    if has_newer:
+        nav_buttons.append(InlineKeyboardButton("⬅️ Newer", callback_data=f"myfiles_prev_{encode_my_files_cursor(user_links[0])}"))
+    if has_older:
+        nav_buttons.append(InlineKeyboardButton("Older ➡️", callback_data=f"myfiles_next_{encode_my_files_cursor(user_links[-1])}"))
+    return text, InlineKeyboardMarkup([nav_buttons]) if nav_buttons else None
+
+@app.on_message(filters.command("myfiles") & filters.private)
+@instrument_handler
+async def my_files_handler(client: Client, message: Message, user_id: int = None):
+    text, keyboard = await build_my_files_page(user_id or message.from_user.id)
     
-    if not user_single_files and not user_multi_files:
+    if not text:
         await message.reply("😔 You haven't uploaded any files or created any bundles yet. Start with sending a file or `/multi_link`.")
         return
-
-    text = "📂 **Your Recent Uploads & Bundles:**\n\n"
-    bot_username = (await client.get_me()).username
     
-    if user_single_files:
-        text += "--- **Single Files (Last 5)** ---\n"
-        for i, file_record in enumerate(user_single_files):
-            file_name = file_record.get('file_name', 'Unnamed File')
-            file_id_str = file_record['_id']
-            share_link = f"https://t.me/{bot_username}?start={file_id_str}"
-            text += f"**{i+1}.** `🔗` [{file_name}]({share_link})\n"
-        text += "\n"
-        
-    if user_multi_files:
-        text += "--- **Multi-File Bundles (Last 5)** ---\n"
-        for i, bundle_record in enumerate(user_multi_files):
-            file_name = bundle_record.get('file_name', f"Bundle of {len(bundle_record.get('message_ids', []))} Files")
-            file_id_str = bundle_record['_id']
-            share_link = f"https://t.me/{bot_username}?start={file_id_str}"
-            text += f"**{i+1}.** `📦` [{file_name}]({share_link})\n"
-        text += "\n"
-
-    text += "_To delete a file, use: `/delete <file_id>`_"
+    await message.reply(text, reply_markup=keyboard, disable_web_page_preview=True)
+
+@app.on_callback_query(filters.regex(r"^myfiles_(next|prev)_"))
+@instrument_handler
+async def my_files_page_callback(client: Client, callback_query: CallbackQuery):
+    # myfiles_<next/prev>_<created_at ms>_<link id>
+    _, direction, cursor = callback_query.data.split("_", 2)
+    text, keyboard = await build_my_files_page(callback_query.from_user.id, direction, cursor)
     
-    await message.reply(text, disable_web_page_preview=True)
+    if not text:
+        await callback_query.answer("No more files here.", show_alert=True)
+        return
+    
+    await callback_query.message.edit_text(text, reply_markup=keyboard, disable_web_page_preview=True)
+    await callback_query.answer()
 
 @app.on_message(filters.command("delete") & filters.private)
+@instrument_handler
 async def delete_file_handler(client: Client, message: Message):
     if len(message.command) < 2:
         await message.reply("Please provide the file or bundle ID to delete. Example: `/delete abcdefgh`")
@@ -765,12 +2903,8 @@ async def delete_file_handler(client: Client, message: Message):
     file_id_str = message.command[1].split('?start=')[-1] # Handle full link being passed
     user_id = message.from_user.id
     
-    # Check both collections
-    file_record = db.files.find_one({"_id": file_id_str, "user_id": user_id})
-    multi_file_record = db.multi_files.find_one({"_id": file_id_str, "user_id": user_id})
-    
-    is_single_file = bool(file_record)
-    record_to_delete = file_record or multi_file_record
+    record_to_delete = await find_link({"_id": file_id_str, "user_id": user_id})
+    is_single_file = bool(record_to_delete) and record_to_delete['type'] == LINK_TYPE_FILE
 
     if not record_to_delete:
         await message.reply("🤔 File or bundle not found, or you don't have permission to delete it.")
@@ -794,8 +2928,9 @@ async def delete_file_handler(client: Client, message: Message):
 # --- Admin Handlers (Enhanced) ---
 
 @app.on_message(filters.command("admin") & filters.private & filters.user(ADMINS))
+@instrument_handler
 async def admin_panel_handler(client: Client, message: Message):
-    current_mode = await get_bot_mode(db)
+    current_mode = get_bot_mode()
     
     buttons = [
         [InlineKeyboardButton("📊 Bot Stats", callback_data="admin_stats"),
@@ -809,41 +2944,88 @@ async def admin_panel_handler(client: Client, message: Message):
     )
 
 @app.on_message(filters.command("stats") & filters.private & filters.user(ADMINS))
+@instrument_handler
 async def stats_handler(client: Client, message: Message):
-    user_count = db.users.count_documents({})
-    single_files_count = db.files.count_documents({})
-    multi_files_count = db.multi_files.count_documents({})
+    now = datetime.utcnow()
+    totals = await db.stats.find_one({"_id": "totals"}) or {}
+    last_hours = await db.stats.find({"_id": {"$gte": stats_hour_key(now - timedelta(hours=23)), "$lte": stats_hour_key(now)}})
+    last_days = {doc["_id"]: doc for doc in await db.stats.find({"_id": {"$gte": stats_day_key(now - timedelta(days=6)), "$lte": stats_day_key(now)}})}
     
+    user_count = totals.get("users", 0)
+    single_files_count = totals.get("files", 0)
+    multi_files_count = totals.get("bundles", 0)
     total_files_count = single_files_count + multi_files_count
-
-    # Calculate time 24 hours ago
-    today_start_dt = datetime.utcnow() - timedelta(days=1)
     
-    today_new_users = db.users.count_documents({"last_activity": {"$gte": today_start_dt}})
-    today_single_files = db.files.count_documents({"created_at": {"$gte": today_start_dt}})
-    today_multi_files = db.multi_files.count_documents({"created_at": {"$gte": today_start_dt}})
+    today_active_users = last_days.get(stats_day_key(now), {}).get("active_users", 0)
+    today_new_users = sum(doc.get("new_users", 0) for doc in last_hours)
+    today_uploads = sum(doc.get("uploads", 0) for doc in last_hours)
     
     # Advanced file type breakdown
-    file_types_cursor = db.files.aggregate([{"$group": {"_id": "$file_type", "count": {"$sum": 1}}}])
-    file_types_text = "\n".join([f"  • {ft['_id'].capitalize()}: **{ft['count']}**" for ft in file_types_cursor if ft['_id']])
+    file_types_text = "\n".join([f"  • {ft.capitalize()}: **{count}**" for ft, count in totals.get("file_types", {}).items() if count])
     if not file_types_text:
         file_types_text = "  • No files recorded."
     
+    history_text = stats_history_chart(now, last_days)
+    
     await message.reply(
         f"📊 **BOT STATISTICS**\n\n"
         f"--- **User & Usage** ---\n"
         f"**👥 Total Users:** `{user_count}`\n"
-        f"**🗓️ Active (Last 24h):** `{today_new_users}`\n\n"
+        f"**🗓️ Active Today (UTC):** `{today_active_users}`\n"
+        f"**🆕 New Users (Last 24h):** `{today_new_users}`\n\n"
         f"--- **Files** ---\n"
         f"**📁 Total Items:** `{total_files_count}`\n"
         f"**📄 Single Files:** `{single_files_count}`\n"
         f"**📦 Multi-Bundles:** `{multi_files_count}`\n"
-        f"**📈 Uploads (Last 24h):** `{today_single_files + today_multi_files}`\n\n"
+        f"**📈 Uploads (Last 24h):** `{today_uploads}`\n\n"
         f"--- **File Breakdown** ---\n"
-        f"{file_types_text}"
+        f"{file_types_text}\n\n"
+        f"--- **Last 7 Days (Uploads · Active Users)** ---\n"
+        f"{history_text}\n\n"
+        f"--- **Caches** ---\n"
+        f"**🔗 Link Records:** {link_cache.stats_text()}\n"
+        f"**🔍 Inline Search:** {inline_search_cache.stats_text()}\n\n"
+        f"--- **Bundle Delivery (Time to Last File)** ---\n"
+        f"{delivery_stats.stats_text()}\n\n"
+        f"--- **Group Moderation** ---\n"
+        f"{moderation_queue.stats_text()}"
+    )
+
+@app.on_message(filters.command("migrate_links") & filters.private & filters.user(ADMINS))
+@instrument_handler
+async def migrate_links_handler(client: Client, message: Message):
+    """Copies legacy files/multi_files records into the unified links collection."""
+    status_msg = await message.reply("⏳ **Migrating links...** This runs in the background while the bot keeps working.")
+
+    async def report_progress(migrated):
+        try:
+            await status_msg.edit_text(f"⏳ **Migrating links...** `{migrated}` records copied so far.")
+        except Exception:
+            pass # Progress updates are best-effort
+
+    try:
+        migrated = await migrate_legacy_links(on_progress=report_progress)
+        tokenised = await backfill_search_tokens()
+        await rebuild_stats_totals()
+        await status_msg.edit_text(
+            f"✅ **Migration Complete!**\n\n`{migrated}` legacy records are now served from the unified links collection.\n"
+            f"`{tokenised}` links were added to the search index."
+        )
+    except Exception as e:
+        logger.error(f"Links migration failed: {e}", exc_info=True)
+        await status_msg.edit_text(f"❌ **Migration failed.** It is safe to run `/migrate_links` again.\n`Error: {e}`")
+
+@app.on_message(filters.command("perf") & filters.private & filters.user(ADMINS))
+@instrument_handler
+async def perf_handler(client: Client, message: Message):
+    """Shows the slowest handlers (by p95) and where their time goes."""
+    report = perf_stats.report()
+    await message.reply(
+        f"⏱️ **Handler Performance** (last {PERF_WINDOW} runs each, slowest p95 first)\n\n{report}"[:TELEGRAM_MESSAGE_LIMIT]
     )
 
 @app.on_message(filters.command("broadcast") & filters.private & filters.user(ADMINS))
+@instrument_handler
 async def broadcast_handler_reply_enhanced(client: Client, message: Message):
     
     # Check for content: either a reply, or text after the command
@@ -870,50 +3052,31 @@ async def broadcast_handler_reply_enhanced(client: Client, message: Message):
         await message.reply("Error: Could not determine broadcast content.")
         return
         
-    # Get all user IDs
-    users = db.users.find({}, {"_id": 1})
-    user_ids = [user['_id'] for user in users]
-    
-    success_count = 0
-    failed_count = 0
-    
-    status_msg = await message.reply(f"⏳ **Starting broadcast to {len(user_ids)} users...**")
-    
-    # Broadcast logic (better implementation with asyncio for speed)
-    async def send_message_task(chat_id, content_message, text_override):
-        nonlocal success_count, failed_count
-        try:
-            if text_override:
-                # Text broadcast via command argument
-                await client.send_message(chat_id=chat_id, text=text_override, disable_web_page_preview=True)
-            elif content_message:
-                # Media/Reply broadcast via copy
-                await content_message.copy(chat_id)
-            success_count += 1
-        except Exception:
-            # Assumed to be user blocked or left
-            failed_count += 1
-            db.users.delete_one({"_id": chat_id}) # Optional: Clean up blocked users
-        await asyncio.sleep(0.1) # Throttle to prevent flooding
-
-    tasks = []
-    for uid in user_ids:
-        if uid != message.from_user.id: # Don't send to self (admin)
-             tasks.append(send_message_task(uid, message.reply_to_message, text_to_send))
-             
-    await asyncio.gather(*tasks)
-    
-    await status_msg.edit_text(
-        f"✅ **Broadcast Complete!**\n\n"
-        f"**Success:** `{success_count}`\n"
-        f"**Failed (Blocked/Left/Cleaned):** `{failed_count}`"
-    )
+    total_users = await db.users.count_documents({"_id": {"$ne": message.from_user.id}})
+    status_msg = await message.reply(f"⏳ **Starting broadcast to {total_users} users...**")
+
+    job = {
+        "status": "running",
+        "admin_id": message.from_user.id,
+        "text": text_to_send,
+        "from_chat_id": message.chat.id if text_to_send is None else None,
+        "message_id": message.reply_to_message.id if text_to_send is None else None,
+        "status_chat_id": status_msg.chat.id,
+        "status_message_id": status_msg.id,
+        "last_user_id": None,
+        "total": total_users,
+        "counts": {outcome: 0 for outcome in BROADCAST_OUTCOMES},
+        "started_at": datetime.utcnow()
+    }
+    job["_id"] = (await db.broadcasts.insert_one(job)).inserted_id
+    asyncio.create_task(run_broadcast(client, job))
 
 # Note: /settings handler removed as it redirects to admin_panel_handler
 
 # --- Callback Query Handlers (Enhanced) ---
 
 @app.on_callback_query(filters.regex("^(about|help|start_menu|my_files_menu|admin_stats|admin_settings|admin_broadcast_prompt|admin|view_my_files|view_force_channels)$"))
+@instrument_handler
 async def general_callback_handler(client: Client, callback_query: CallbackQuery):
     query = callback_query.data
     
@@ -950,7 +3113,7 @@ async def general_callback_handler(client: Client, callback_query: CallbackQuery
          
     elif query == "my_files_menu":
         buttons = [
-            [InlineKeyboardButton("📂 View My Last 10 Files", callback_data="view_my_files")],
+            [InlineKeyboardButton("📂 Browse My Files", callback_data="view_my_files")],
             [InlineKeyboardButton("🔗 View Force Join Channels", callback_data="view_force_channels")],
             [InlineKeyboardButton("🔙 Back to Start", callback_data="start_menu")]
         ]
@@ -958,7 +3121,7 @@ async def general_callback_handler(client: Client, callback_query: CallbackQuery
         keyboard = InlineKeyboardMarkup(buttons)
         
     elif query == "view_my_files":
-         await my_files_handler(client, callback_query.message)
+         await my_files_handler(client, callback_query.message, user_id=callback_query.from_user.id)
          await callback_query.answer()
          return
          
@@ -973,7 +3136,7 @@ async def general_callback_handler(client: Client, callback_query: CallbackQuery
 
     # --- Admin Panel Callbacks ---
     elif query == "admin_settings":
-        current_mode = await get_bot_mode(db)
+        current_mode = get_bot_mode()
         
         public_button = InlineKeyboardButton("🌍 Public (Anyone)", callback_data="set_mode_public")
         private_button = InlineKeyboardButton("🔒 Private (Admins Only)", callback_data="set_mode_private")
@@ -1007,6 +3170,7 @@ async def general_callback_handler(client: Client, callback_query: CallbackQuery
     await callback_query.answer()
     
 @app.on_callback_query(filters.regex(r"^check_join_"))
+@instrument_handler
 async def check_join_callback(client: Client, callback_query: CallbackQuery):
     user_id = callback_query.from_user.id
     # Split the data, file_id_str is the third part if it exists
@@ -1017,16 +3181,13 @@ async def check_join_callback(client: Client, callback_query: CallbackQuery):
     all_channels_to_check = list(FORCE_CHANNELS)
     
     if file_id_str and file_id_str != 'force': # 'force' is the fallback for generic check
-        file_record = db.files.find_one({"_id": file_id_str})
-        multi_file_record = db.multi_files.find_one({"_id": file_id_str})
+        link_record = await resolve_link(file_id_str)
 
-        if file_record and file_record.get('force_channel'):
-            all_channels_to_check.append(file_record['force_channel'])
-        elif multi_file_record and multi_file_record.get('force_channel'):
-            all_channels_to_check.append(multi_file_record['force_channel'])
+        if link_record and link_record.get('force_channel'):
+            all_channels_to_check.append(link_record['force_channel'])
     
     all_channels_to_check = list(set(all_channels_to_check))
-    missing_channels = await is_user_member_all_channels(client, user_id, all_channels_to_check)
+    missing_channels = await is_user_member_all_channels(client, user_id, all_channels_to_check, recheck_missing=True)
 
     if not missing_channels:
         await callback_query.answer("Thanks for joining! Sending files now... 🥳", show_alert=True)
@@ -1057,6 +3218,7 @@ async def check_join_callback(client: Client, callback_query: CallbackQuery):
         )
 
 @app.on_callback_query(filters.regex(r"^set_mode_"))
+@instrument_handler
 async def set_mode_callback(client: Client, callback_query: CallbackQuery):
     if callback_query.from_user.id not in ADMINS:
         await callback_query.answer("❌ Permission Denied! Only Admins can change bot mode.", show_alert=True)
@@ -1064,11 +3226,12 @@ async def set_mode_callback(client: Client, callback_query: CallbackQuery):
         
     new_mode = callback_query.data.split("_")[2]
     
-    db.settings.update_one(
+    await db.settings.update_one(
         {"_id": "bot_mode"},
         {"$set": {"mode": new_mode}},
         upsert=True
     )
+    settings_snapshot.apply("bot_mode", {"mode": new_mode})
     
     await callback_query.answer(f"Mode successfully set to {new_mode.upper()}!", show_alert=True)
     
@@ -1084,6 +3247,7 @@ async def set_mode_callback(client: Client, callback_query: CallbackQuery):
     )
 
 @app.on_callback_query(filters.regex(r"^confirm_delete_"))
+@instrument_handler
 async def confirm_delete_callback(client: Client, callback_query: CallbackQuery):
     user_id = callback_query.from_user.id
     # confirm_delete_<file_id>_<single/multi>
@@ -1091,9 +3255,7 @@ async def confirm_delete_callback(client: Client, callback_query: CallbackQuery)
     file_id_str = parts[2]
     item_type = parts[3] 
 
-    collection = db.files if item_type == 'single' else db.multi_files
-    
-    record_to_delete = collection.find_one({"_id": file_id_str, "user_id": user_id})
+    record_to_delete = await find_link({"_id": file_id_str, "user_id": user_id})
 
     if not record_to_delete:
         await callback_query.answer("File/Bundle not found or already deleted.", show_alert=True)
@@ -1105,21 +3267,20 @@ async def confirm_delete_callback(client: Client, callback_query: CallbackQuery)
 
     try:
         # Delete from LOG_CHANNEL
-        if item_type == 'single':
+        if record_to_delete['type'] == LINK_TYPE_FILE:
             # Pyrogram's delete_messages requires a list of message_ids
             message_ids_to_delete = [record_to_delete['message_id']]
         else: # multi
             message_ids_to_delete = record_to_delete['message_ids']
             
         # Delete messages in batches to handle Pyrogram's API limits better
-        chunk_size = 100 
-        for i in range(0, len(message_ids_to_delete), chunk_size):
-            chunk = message_ids_to_delete[i:i + chunk_size]
+        for i in range(0, len(message_ids_to_delete), DELETE_BATCH_SIZE):
+            chunk = message_ids_to_delete[i:i + DELETE_BATCH_SIZE]
             await client.delete_messages(chat_id=LOG_CHANNEL, message_ids=chunk)
             await asyncio.sleep(0.5) # Throttle
             
         # Delete from database
-        collection.delete_one({"_id": file_id_str})
+        await delete_link(record_to_delete)
 
         await callback_query.answer(f"Item deleted successfully! ID: {file_id_str}", show_alert=True)
         await callback_query.message.edit_text(f"✅ The {item_type.upper()} item **`{record_to_delete.get('file_name', 'Unnamed Item')}`** has been permanently deleted.")
@@ -1130,14 +3291,14 @@ async def confirm_delete_callback(client: Client, callback_query: CallbackQuery)
             f"• **Type:** `{item_type.upper()}`\n"
             f"• **ID:** `{file_id_str}`"
         )
-        await client.send_message(LOG_CHANNEL, log_text)
+        log_sink.post(LOG_CHANNEL, log_text)
         
     except Exception as e:
         logger.error(f"Failed to delete item {file_id_str}: {e}", exc_info=True)
         # Check if the error is due to message already deleted (common case)
         if "MESSAGE_DELETE_FORBIDDEN" in str(e) or "MESSAGE_NOT_FOUND" in str(e):
              # Still delete from DB if Telegram failed to find/delete (to clean up)
-             collection.delete_one({"_id": file_id_str})
+             await delete_link(record_to_delete)
              await callback_query.answer("Item deleted from database, but message removal from log channel failed (already deleted or access issue).", show_alert=True)
              await callback_query.message.edit_text(f"✅ The {item_type.upper()} item **`{record_to_delete.get('file_name', 'Unnamed Item')}`** has been deleted from the database.")
         else:
@@ -1145,12 +3306,14 @@ async def confirm_delete_callback(client: Client, callback_query: CallbackQuery)
              await callback_query.message.edit_text("❌ An error occurred while trying to delete the item. Please try again later.")
 
 @app.on_callback_query(filters.regex(r"^cancel_delete"))
+@instrument_handler
 async def cancel_delete_callback(client: Client, callback_query: CallbackQuery):
     await callback_query.answer("Deletion cancelled.", show_alert=True)
     await callback_query.message.edit_text("↩️ Deletion cancelled. Your file/bundle is safe.")
 
 # --- NEW: Inline Search Handler ---
 @app.on_inline_query()
+@instrument_handler
 async def inline_search(client, inline_query):
     query = inline_query.query.strip().lower()
     
@@ -1168,26 +3331,21 @@ async def inline_search(client, inline_query):
         await client.answer_inline_query(inline_query.id, results, cache_time=0)
         return
 
-    # Search in both collections
-    single_files_found = list(db.files.find(
-        {"user_id": inline_query.from_user.id, "file_name": {"$regex": query, "$options": "i"}}
-    ).limit(7))
-    
-    multi_files_found = list(db.multi_files.find(
-        {"user_id": inline_query.from_user.id, "file_name": {"$regex": query, "$options": "i"}}
-    ).limit(7))
-    
-    all_found = single_files_found + multi_files_found
-    all_found.sort(key=lambda x: x['created_at'], reverse=True) # Sort by creation time
+    terms = search_tokens(query)
+    offset = int(inline_query.offset) if (inline_query.offset or "").isdigit() else 0
+    ranked = await cached_inline_search(inline_query.from_user.id, terms) if terms else []
+    if ranked is None:
+        return # A newer query from this user is being answered instead
+    page = ranked[offset:offset + SEARCH_PAGE_SIZE]
+    next_offset = str(offset + SEARCH_PAGE_SIZE) if offset + SEARCH_PAGE_SIZE < len(ranked) else ""
     
     articles = []
-    bot_username = (await client.get_me()).username
     
-    for item_record in all_found[:15]: # Limit to max 15 results
+    for item_record in page:
         file_id_str = item_record['_id']
-        share_link = f"https://t.me/{bot_username}?start={file_id_str}"
+        share_link = bot_context.share_link(file_id_str)
         
-        is_single = 'message_id' in item_record
+        is_single = item_record['type'] == LINK_TYPE_FILE
         item_type = "File" if is_single else "Bundle"
         file_name = item_record.get('file_name', f"Unnamed {item_type}")
         
@@ -1207,7 +3365,7 @@ async def inline_search(client, inline_query):
             )
         )
         
-    if not articles:
+    if not articles and offset == 0:
         articles.append(
             InlineQueryResultArticle(
                 title="❌ No Files Found",
@@ -1221,7 +3379,8 @@ async def inline_search(client, inline_query):
     await client.answer_inline_query(
         inline_query.id,
         results=articles,
-        cache_time=5
+        cache_time=5,
+        next_offset=next_offset
     )
 
 
@@ -1232,6 +3391,7 @@ async def inline_search(client, inline_query):
 
 # --- BUG FIX: This logic was floating in your code. I've wrapped it in a handler. ---
 @app.on_message(filters.group & (filters.text | filters.caption))
+@instrument_handler
 async def group_message_handler(client: Client, message: Message):
     
     if not message.from_user:
@@ -1241,28 +3401,123 @@ async def group_message_handler(client: Client, message: Message):
          return # Ignore messages from bots or admins
          
     text_with_caption = message.text or message.caption
+    user_name = await get_user_full_name(message.from_user)
+    where = f"{user_name} (`{message.from_user.id}`) in {message.chat.title} (`{message.chat.id}`)"
     
     # 1. Anti-Link Filter
-    if message.entities or message.caption_entities:
-        entities = message.entities if message.entities else message.caption_entities
-        
-        for entity in entities:
-            # Check for URL, text_link, or bot mention/command which can sometimes be abused
-            if entity.type in ["url", "text_link", "text_mention"]: # Added text_mention as it can hide links
-                try:
-                    await message.delete()
-                    await message.reply(
-                        f"🚫 **Link Removed!** {await get_user_full_name(message.from_user)}, unauthorized links are not allowed here.",
-                        quote=True
-                    )
-                    
-                    log_text = (
-                        f"🔗 **Link Removed!**\n"
-                        f"• **User:** {await get_user_full_name(message.from_user)} (`{message.from_user.id}`)\n"
-                        f"• **Group:** {message.chat.title} (`{message.chat.id}`)\n"
-                        f"• **Entity Type:** `{entity.type}`"
-                    )
-                    if GROUP_LOG_CHANNEL: await client.send_message(GROUP_LOG_CHANNEL, log_text)
-                    return
-                except ChatAdminRequired:
-                    return
+    # Check for URL, text_link, or text_mention (which can hide links)
+    entities = message.entities or message.caption_entities or []
+    link_entity = next((entity for entity in entities if entity.type in LINK_ENTITY_TYPES), None)
+    if link_entity:
+        moderation_queue.remove(
+            client, message,
+            notice=f"🚫 **Link Removed!** {user_name}, unauthorized links are not allowed here.",
+            log_line=f"🔗 `{link_entity.type.name.lower()}` removed from {where}"
+        )
+        return
+
+    # 2. Bad-Word Filter
+    badword = find_badword(text_with_caption)
+    if badword:
+        alert = None
+        notice = f"⚠️ {user_name}, abusive language is not allowed here."
+        try:
+            warnings = await add_warning(message.chat.id, message.from_user.id)
+            if warnings >= MAX_WARNINGS:
+                moderation_queue.record_rpc()
+                action = await punish_user(client, message.chat.id, message.from_user.id)
+                await reset_warnings(message.chat.id, message.from_user.id)
+                alert = notice = f"⛔ **{user_name}** reached {MAX_WARNINGS} warnings and has been {action}."
+            else:
+                action = f"warned ({warnings}/{MAX_WARNINGS})"
+                notice = f"⚠️ **Warning {warnings}/{MAX_WARNINGS}** for {user_name}: abusive language is not allowed here."
+        except Exception as e:
+            logger.error(f"Failed to warn or punish {message.from_user.id} in {message.chat.id}: {e}")
+            action = "not punished (error)"
+
+        moderation_queue.remove(
+            client, message,
+            notice=notice,
+            log_line=f"🤬 `{badword}` removed from {where}: {action}",
+            alert=alert
+        )
+
+# --- Health & Metrics Server ---
+# Runs on the bot's own event loop. /healthz checks Mongo and the Telegram connection, /readyz
+# reports whether startup has finished, and /metrics exposes the Prometheus metrics.
+HEALTH_PORT = int(os.environ.get('PORT', 8080))
+HEALTH_CHECK_TIMEOUT = 3
+bot_ready = asyncio.Event()
+
+QUEUE_GAUGES = {
+    "bundle_ingest": lambda: bundle_ingest_queue.qsize(),
+    "activity": lambda: activity_tracker.qsize(),
+    "moderation": lambda: moderation_queue.qsize(),
+    "log_sink": lambda: log_sink.qsize(),
+}
+for queue_name, size in QUEUE_GAUGES.items():
+    QUEUE_DEPTH.labels(queue=queue_name).set_function(size)
+
+async def index_route(request):
+    return web.Response(text="Bot is alive! 🚀")
+
+async def healthz_route(request):
+    checks = {"telegram": "connected" if app.is_connected else "disconnected"}
+    try:
+        loop = asyncio.get_running_loop()
+        await asyncio.wait_for(loop.run_in_executor(mongo_executor, client.admin.command, "ping"), HEALTH_CHECK_TIMEOUT)
+        checks["mongo"] = "ok"
+    except Exception as e:
+        checks["mongo"] = f"error: {e}"
+    healthy = checks["mongo"] == "ok" and app.is_connected
+    return web.json_response(checks, status=200 if healthy else 503)
+
+async def readyz_route(request):
+    ready = bot_ready.is_set() and app.is_connected
+    return web.json_response({"ready": ready}, status=200 if ready else 503)
+
+async def metrics_route(request):
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+async def start_health_server() -> web.AppRunner:
+    health_app = web.Application()
+    health_app.router.add_get("/", index_route)
+    health_app.router.add_get("/healthz", healthz_route)
+    health_app.router.add_get("/readyz", readyz_route)
+    health_app.router.add_get("/metrics", metrics_route)
+    runner = web.AppRunner(health_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", HEALTH_PORT).start()
+    logger.info(f"🩺 Health server listening on port {HEALTH_PORT}.")
+    return runner
+
+# --- Main Entry Point ---
+
+async def main():
+    health_runner = await start_health_server()
+    await settings_snapshot.start()
+    await link_ids.assign_worker()
+    await ensure_indexes()
+    await ensure_stats_totals()
+    await verify_query_plans()
+    asyncio.create_task(auto_migrate_links())
+    asyncio.create_task(ensure_search_tokens())
+    await app.start()
+    await bot_context.refresh(app)
+    await deletion_scheduler.start(app)
+    await resume_broadcasts(app)
+    bundle_ingest_queue.start(app)
+    activity_tracker.start()
+    moderation_queue.start()
+    log_sink.start(app)
+    bot_ready.set()
+    logger.info("🚀 Bot started successfully!")
+    await idle()
+    bot_ready.clear()
+    await log_sink.stop(app)
+    await app.stop()
+    await activity_tracker.stop()
+    await health_runner.cleanup()
+
+if __name__ == "__main__":
+    app.run(main())